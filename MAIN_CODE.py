@@ -1,18 +1,39 @@
 import socket
-import threading
 import tkinter as tk
-from tkinter import simpledialog, colorchooser, messagebox
-import pickle
+from tkinter import simpledialog, colorchooser, messagebox, filedialog
 import random
 import string
-
-
-BUFFER_SIZE = 8192    # Size of the buffer for receiving data 
-BROADCAST_PORT = 37020  # Port for broadcasting room codes
-DRAW = "DRAW"  # Message type for drawing actions
-CLEAR = "CLEAR"  # Message type for clearing the canvas
-PEER = "PEER"  # Message type for peer information
-MAP = "MAP"  # Message type for broadcasting room maps
+import queue
+import os
+import re
+import sys
+import time
+from protocol import HELLO, DRAW, CLEAR, PEER, SNAPSHOT, SYNC_END, SYNC_ACK, TOMBSTONE, PING, GONE, encode
+from network import NetworkEngine, CONNECTED, MESSAGE, CLOSED, CONNECT_FAILED, OUTBOX_SIZE, HEARTBEAT_SECONDS
+from discovery import Announcer, DiscoveryListener
+from render import RenderQueue
+from metrics import Metrics
+from board import Board
+from batching import StrokeBatcher
+from sync import catch_up_plan, compress_part, apply_snapshot, snapshot_parts
+from session_log import SessionLog, SessionReader, export_bytes
+from offload import Offloader
+import relay
+
+
+ROOM_LIST_MS = 1000     # Refresh interval of the live room list in the join dialog
+POLL_MS = 10    # How often the Tk loop drains network events
+MAX_EVENTS_PER_POLL = 200   # Network events handled per poll before yielding back to Tk
+CONNECT_TIMEOUT = 5     # Seconds to wait when joining a room
+LIVE_TAG = "live"       # Canvas tag for segments of the stroke being drawn locally
+ZOOM_STEP = 1.2         # Zoom factor per mouse wheel notch
+SESSION_DIR = "sessions"    # Where session logs are written
+STATS_MS = 500          # Refresh interval of the stats panel
+OFFLOAD_MIN_BYTES = 256 * 1024  # Smaller snapshots are compressed right away, bigger ones in the process pool
+HEARTBEAT_MS = int(HEARTBEAT_SECONDS * 1000)    # Interval between pings to every peer
+RECONNECT_BASE_MS = 500     # First delay before redialing a lost peer, doubled after every failed attempt
+RECONNECT_MAX_MS = 8000     # Longest delay between two attempts
+RECONNECT_ATTEMPTS = 6      # Attempts before a lost peer is given up on
 
 
 # Generate random room code
@@ -20,9 +41,15 @@ def generate_room_code(length = 6) :
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
 
 
+# Path of the log file for a new session, the name is typed by the user so only word characters are kept
+def session_path(user_name):
+    safe_name = re.sub(r'[^\w-]', '_', user_name)
+    return os.path.join(SESSION_DIR, f"{safe_name}-{time.strftime('%Y%m%d-%H%M%S')}.wblog")
+
+
 # Whiteboard GUI Class
 class Whiteboard:
-    def __init__(self, master, ip, port, user_name, is_host = False, room_code = None): # Initialize the Whiteboard
+    def __init__(self, master, ip, port, user_name, is_host = False, room_code = None, session_file = None): # Initialize the Whiteboard
 
         self.master = master  # Reference to the main Tkinter window
         self.master.title("Peer-to-Peer Whiteboard")  # Set the window title
@@ -35,6 +62,8 @@ class Whiteboard:
         # Canvas
         self.canvas = tk.Canvas(self.master, bg="white", width=800, height=600)
         self.canvas.pack(fill=tk.BOTH, expand=True)
+        self.init_state(ip, port, user_name, session_file)
+        self.renderer = RenderQueue(self.canvas, metrics=self.metrics, offload=self.offload)    # Remote strokes are drawn in batches from the Tk thread
 
       
         # Toolbar
@@ -105,6 +134,105 @@ class Whiteboard:
         self.clear_button.bind("<Enter>", on_enter_clear)
         self.clear_button.bind("<Leave>", on_leave_clear)
 
+        self.undo_button = tk.Button(self.toolbar, text="Undo", command=self.undo, bg="lightblue", fg="black", font=("Comic Sans MS", 10, "bold"), relief=tk.RAISED, bd=2) # Take back the last stroke or erase (Ctrl+Z)
+        self.undo_button.pack(side=tk.LEFT, padx=5)
+
+        def on_enter_undo(e):
+            self.undo_button['background'] = 'deepskyblue'
+            self.undo_button['cursor'] = 'hand2'
+
+        def on_leave_undo(e):
+            self.undo_button['background'] = 'lightblue'
+            self.undo_button['cursor'] = ''
+
+        self.undo_button.bind("<Enter>", on_enter_undo)
+        self.undo_button.bind("<Leave>", on_leave_undo)
+
+        self.redo_button = tk.Button(self.toolbar, text="Redo", command=self.redo, bg="lightblue", fg="black", font=("Comic Sans MS", 10, "bold"), relief=tk.RAISED, bd=2) # Put back what was undone (Ctrl+Y)
+        self.redo_button.pack(side=tk.LEFT, padx=5)
+
+        def on_enter_redo(e):
+            self.redo_button['background'] = 'deepskyblue'
+            self.redo_button['cursor'] = 'hand2'
+
+        def on_leave_redo(e):
+            self.redo_button['background'] = 'lightblue'
+            self.redo_button['cursor'] = ''
+
+        self.redo_button.bind("<Enter>", on_enter_redo)
+        self.redo_button.bind("<Leave>", on_leave_redo)
+
+        self.eraser_button = tk.Button(self.toolbar, text="Eraser", command=self.toggle_eraser, bg="lightblue", fg="black", font=("Comic Sans MS", 10, "bold"), relief=tk.RAISED, bd=2) # While pressed, dragging removes whole strokes
+        self.eraser_button.pack(side=tk.LEFT, padx=5)
+
+        def on_enter_eraser(e):
+            self.eraser_button['background'] = 'deepskyblue'
+            self.eraser_button['cursor'] = 'hand2'
+
+        def on_leave_eraser(e):
+            self.eraser_button['background'] = 'lightblue'
+            self.eraser_button['cursor'] = ''
+
+        self.eraser_button.bind("<Enter>", on_enter_eraser)
+        self.eraser_button.bind("<Leave>", on_leave_eraser)
+
+        self.view_button = tk.Button(self.toolbar, text="Reset View", command=self.reset_view, bg="lightblue", fg="black", font=("Comic Sans MS", 10, "bold"), relief=tk.RAISED, bd=2) # Go back to the origin at 100% zoom
+        self.view_button.pack(side=tk.LEFT, padx=5)
+
+        def on_enter_view(e):
+            self.view_button['background'] = 'deepskyblue'
+            self.view_button['cursor'] = 'hand2'
+
+        def on_leave_view(e):
+            self.view_button['background'] = 'lightblue'
+            self.view_button['cursor'] = ''
+
+        self.view_button.bind("<Enter>", on_enter_view)
+        self.view_button.bind("<Leave>", on_leave_view)
+
+        self.open_button = tk.Button(self.toolbar, text="Open", command=self.open_session, bg="lightblue", fg="black", font=("Comic Sans MS", 10, "bold"), relief=tk.RAISED, bd=2) # Restore a board from a session log
+        self.open_button.pack(side=tk.LEFT, padx=5)
+
+        def on_enter_open(e):
+            self.open_button['background'] = 'deepskyblue'
+            self.open_button['cursor'] = 'hand2'
+
+        def on_leave_open(e):
+            self.open_button['background'] = 'lightblue'
+            self.open_button['cursor'] = ''
+
+        self.open_button.bind("<Enter>", on_enter_open)
+        self.open_button.bind("<Leave>", on_leave_open)
+
+        self.export_button = tk.Button(self.toolbar, text="Export", command=self.export_board, bg="lightblue", fg="black", font=("Comic Sans MS", 10, "bold"), relief=tk.RAISED, bd=2) # Save the board as PNG or SVG
+        self.export_button.pack(side=tk.LEFT, padx=5)
+
+        def on_enter_export(e):
+            self.export_button['background'] = 'deepskyblue'
+            self.export_button['cursor'] = 'hand2'
+
+        def on_leave_export(e):
+            self.export_button['background'] = 'lightblue'
+            self.export_button['cursor'] = ''
+
+        self.export_button.bind("<Enter>", on_enter_export)
+        self.export_button.bind("<Leave>", on_leave_export)
+
+        self.stats_button = tk.Button(self.toolbar, text="Stats", command=self.toggle_stats, bg="lightblue", fg="black", font=("Comic Sans MS", 10, "bold"), relief=tk.RAISED, bd=2) # Show live metrics over the canvas
+        self.stats_button.pack(side=tk.LEFT, padx=5)
+
+        def on_enter_stats(e):
+            self.stats_button['background'] = 'deepskyblue'
+            self.stats_button['cursor'] = 'hand2'
+
+        def on_leave_stats(e):
+            self.stats_button['background'] = 'lightblue'
+            self.stats_button['cursor'] = ''
+
+        self.stats_button.bind("<Enter>", on_enter_stats)
+        self.stats_button.bind("<Leave>", on_leave_stats)
+        self.stats_panel = None
+
         
 
         self.peers_label = tk.Label(self.toolbar, text="Connected Peers:", font=("Comic Sans MS", 10, "bold"))
@@ -113,141 +241,456 @@ class Whiteboard:
         self.peers_list = tk.Listbox(self.toolbar, height=3, width=30, bg="lightblue", fg="black", font=("Comic Sans MS", 10, "bold"), relief=tk.RAISED, bd=2)
         self.peers_list.pack(side=tk.LEFT, padx=5)
 
+        # Start the server and the network polling
+        self.start_networking()
+
+        # Broadcast room code if host
+        if is_host and room_code:
+            self.room_code = room_code                                                  # Room code for the host
+            self.announcer = Announcer(room_code, self.ip, self.port, self.room_status).start()  # Announce the room in the background
+
+        # Canvas Events
+        self.canvas.bind('<B1-Motion>', self.draw)          # Bind the left mouse button motion to the draw method
+        self.canvas.bind('<ButtonRelease-1>', self.reset)   # Bind the left mouse button release to the reset method
+        self.canvas.bind('<ButtonPress-1>', self.erase)     # Clicks only matter in eraser mode
+        self.master.bind('<Control-z>', self.undo)
+        self.master.bind('<Control-y>', self.redo)
+        for button in (2, 3):                               # Middle or right drag pans the board
+            self.canvas.bind(f'<ButtonPress-{button}>', self.start_pan)
+            self.canvas.bind(f'<B{button}-Motion>', self.pan)
+        self.canvas.bind('<MouseWheel>', self.zoom)         # Windows and macOS wheel
+        self.canvas.bind('<Button-4>', self.zoom)           # Linux wheel up
+        self.canvas.bind('<Button-5>', self.zoom)           # Linux wheel down
+        self.canvas.bind('<Configure>', lambda e: self.renderer.redraw_items())   # Window resized, show what is now in view
+
+        self.master.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.renderer.start(self.master)
+
+    def init_state(self, ip, port, user_name, session_file=None, offload_workers=None):
+        # Drawing and networking state that needs no widget, shared with the headless benchmark peers
+        self.metrics = Metrics()                    # Counters and timings of the hot paths, shown by the Stats button
+        self.offload = Offloader(offload_workers, metrics=self.metrics).start(self.master)  # Smoothing, compression and exports run in worker processes
+
         # Variables for drawing
         self.old_x = None
         self.old_y = None
         self.brush_color = 'black'
         self.brush_size = 2
+        self.board = Board(user_name)   # Every stroke on the whiteboard, local and remote
+        self.undo_stack = []            # (stroke_id, removed) of local strokes and erases, newest last
+        self.redo_stack = []
+        self.erasing = False
+        self.batcher = StrokeBatcher(self.board, self.send_draw_chunk, self.master)   # Decides when local points go out
 
         # Networking
         self.ip = ip                                                    # IP address of the host
         self.port = port                                                # Port number for the host
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)   # Create a TCP socket for the host with ipv4
-        self.peers = []                                                 # List of connected peers
+        self.net = NetworkEngine().start()                              # One asyncio loop thread owns every peer socket
+        self.peers = []                                                 # List of connected peer ids
+        self.peer_addrs = {}                                            # Peer id -> listening address of that peer
+        self.connecting = set()                                         # Addresses we are currently dialing
         self.peer_map = {}                                              # Dictionary of peer names and addresses
-        self.user_name = user_name                                      # Name of the user      
+        self.peers_told = {}                                            # Peer id -> peer map entries already sent to it
+        self.dialed = set()                                             # Addresses we connected to, we redial them when lost
+        self.reconnecting = {}                                          # Lost address -> number of the next redial attempt
+        self.marks = {}                                                 # Address -> board version of its last ping, to resume from
+        self.introduced = {}                                            # Address -> board version when a PEER message first named it
+        self.user_name = user_name                                      # Name of the user
+        self.announcer = None                                           # Set when hosting a room
 
-        # Start server thread
-        threading.Thread(target=self.start_server, daemon=True).start()     # Start the server thread in the background
+        # Every DRAW and CLEAR, local or remote, is appended to the session log in the background
+        self.session_log = SessionLog(session_file, self.board) if session_file else None
+
+    def start_networking(self):
+        # Binding happens on the network thread, this returns once listening
+        self.start_server()
+
+        # Network events are handed to the Tk thread through the engine's inbox
+        self.master.after(POLL_MS, self.receive_data)
+        self.master.after(HEARTBEAT_MS, self.heartbeat)
 
-        # Broadcast room code if host
-        if is_host and room_code:
-            self.room_code = room_code                                                  # Room code for the host
-            threading.Thread(target=self.broadcast_room_code, daemon=True).start()      # Start the broadcast thread in the background
 
-        # Canvas Events
-        self.canvas.bind('<B1-Motion>', self.draw)          # Bind the left mouse button motion to the draw method
-        self.canvas.bind('<ButtonRelease-1>', self.reset)   # Bind the left mouse button release to the reset method
-  
     def start_server(self):
         try:
-            
-            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)     # Set the socket option to reuse the address
-            self.sock.bind((self.ip, self.port))                                # Bind the socket to the host IP and port
-
+            bound_ip, bound_port = self.net.listen(self.ip, self.port)     # Bind the listening socket on the network thread
             if self.port == 0:
-                self.port = self.sock.getsockname()[1]                          # Get the port number if it was set to 0
+                self.port = bound_port                                      # Get the port number if it was set to 0
             print(f"Server started at {self.ip}:{self.port}")
 
-            self.peer_map[self.user_name] = (self.ip, self.port)               # Add the host to the peer map
-            self.update_peers_list()                                           # Update the list of connected peers
-
-            self.sock.listen(5)                                                     # Listen for incoming connections
-            while True:
-                conn, addr = self.sock.accept()                             # Accept incoming connections        
-                data = conn.recv(BUFFER_SIZE)                               # Receive data from the connection
-                peer_name, peer_ip, peer_port = pickle.loads(data)          # Unpack the data into peer name, IP, and port
-                self.peers.append(conn)                                     # Add the connection to the list of peers
-                self.peer_map[peer_name] = (peer_ip, peer_port)             # Add the peer to the peer map
-                self.update_peers_list()                                    # Update the list of connected peers
-                print(f"Peer connected: {peer_name} ({peer_ip}:{peer_port})")
-                self.broadcast_peers()                                                          # Broadcast the updated list of peers
-                threading.Thread(target=self.receive_data, args=(conn,), daemon=True).start()   # Start a thread to receive data from the peer
+            self.peer_map[self.user_name] = (self.ip, self.port)           # Add the host to the peer map
+            self.update_peers_list()                                       # Update the list of connected peers
         except Exception as e:
             print(f"Server error: {e}")
 
-    def broadcast_room_code(self):
-        broadcast_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        broadcast_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-        while True:
-            try:
-                data = pickle.dumps((MAP, {self.room_code: (self.ip, self.port)}))
-                broadcast_sock.sendto(data, ('<broadcast>', BROADCAST_PORT))
-                threading.Event().wait(5)
-            except Exception as e:
-                print(f"Broadcast error: {e}")
+    def room_status(self):
+        # Peer count and load (fullest send queue, percent) carried by room announcements
+        depths = self.net.queue_depths()
+        return len(self.peers) + 1, max(depths.values(), default=0) * 100 // OUTBOX_SIZE
+
+    def send_to_peers(self, data):
+        # Queues the frame for every peer and returns immediately, the network thread does the writing
+        self.net.broadcast(data, tuple(self.peers))
 
     def draw(self, event):
+        started = time.perf_counter()
+        if self.erasing:
+            self.erase(event)
+            return
         if self.old_x and self.old_y:
             x, y = event.x, event.y
             self.brush_size = self.size_slider.get()
-            self.canvas.create_line(self.old_x, self.old_y, x, y, width=self.brush_size, fill=self.brush_color, capstyle=tk.ROUND, smooth=tk.TRUE)
-            
-            # Aggregate drawing data
-            if not hasattr(self, 'draw_data'):
-                self.draw_data = []
-            self.draw_data.append((self.old_x, self.old_y, x, y, self.brush_color, self.brush_size))
-            
-            # Batch send drawing data
-            if len(self.draw_data) >= 10:  # Adjust the batch size as needed
-                data = pickle.dumps((DRAW, self.draw_data))
-                for peer in self.peers:
-                    try:
-                        peer.send(data)
-                    except Exception as e:
-                        print(f"Error sending draw data: {e}")
-                self.draw_data = []  # Clear the batch after sending
+            self.canvas.create_line(self.old_x, self.old_y, x, y, width=self.brush_size, fill=self.brush_color, capstyle=tk.ROUND, smooth=tk.TRUE, tags=LIVE_TAG)
+
+            # Start a new stroke on the first motion, or when the brush changed mid-stroke
+            view = self.renderer.viewport
+            stroke = self.batcher.stroke
+            if stroke is None or stroke.color != self.brush_color or stroke.width != self.brush_size:
+                self.end_stroke()
+                self.batcher.begin(self.brush_color, self.brush_size, *view.to_world(self.old_x, self.old_y))
+            self.batcher.add_point(*view.to_world(x, y))   # Board coordinates; sent on the latency deadline, the byte budget or release
 
         self.old_x, self.old_y = event.x, event.y
+        self.metrics.observe("draw", time.perf_counter() - started)
+
+    def send_draw_chunk(self, chunk):
+        # Each connection encodes the chunk against what it already sent (see protocol.StrokeEncoder)
+        started = time.perf_counter()
+        self.net.broadcast_strokes([chunk], tuple(self.peers))
+        self.log(DRAW, [chunk])
+        self.metrics.observe("flush_draw_data", time.perf_counter() - started)
+        self.metrics.inc("draw_chunks_sent", len(self.peers))
+
+    def log(self, message_type, payload=None):
+        if self.session_log:
+            self.session_log.append(message_type, payload)
 
     def flush_draw_data(self):
-        if hasattr(self, 'draw_data') and self.draw_data:
-            data = pickle.dumps((DRAW, self.draw_data))
-            for peer in self.peers:
-                try:
-                    peer.send(data)
-                except Exception as e:
-                    print(f"Error sending draw data: {e}")
-            self.draw_data = []
+        self.batcher.flush()
+
+    def end_stroke(self):
+        # Send the tail and swap the live segments for a single polyline item
+        stroke = self.batcher.end()
+        if stroke is not None:
+            self.canvas.delete(LIVE_TAG)
+            self.renderer.show_stroke(stroke)
+            self.undo_stack.append((stroke.stroke_id, False))
+            self.redo_stack.clear()
 
     def reset(self, event):
+        self.end_stroke()
         self.old_x, self.old_y = None, None
 
+    def start_pan(self, event):
+        self.pan_x, self.pan_y = event.x, event.y
+
+    def pan(self, event):
+        self.renderer.pan(event.x - self.pan_x, event.y - self.pan_y)
+        self.pan_x, self.pan_y = event.x, event.y
+
+    def zoom(self, event):
+        zoom_in = event.num == 4 or getattr(event, 'delta', 0) > 0
+        self.renderer.zoom(ZOOM_STEP if zoom_in else 1 / ZOOM_STEP, event.x, event.y)
+
+    def reset_view(self):
+        self.renderer.reset_view()
+
     def clear_canvas(self):
-        self.canvas.delete("all")
-        data = pickle.dumps((CLEAR, None))
-        for peer in self.peers:
-            try:
-                peer.send(data)
-            except Exception as e:
-                print(f"Error sending clear command: {e}")
-
-    def receive_data(self, conn):
-        while True:
-            try:
-                data = conn.recv(BUFFER_SIZE)
-                if not data:
-                    break
-                message_type, payload = pickle.loads(data)
-                if message_type == DRAW:
-                    for draw_data in payload:
-                        old_x, old_y, x, y, color, size = draw_data
-                        self.canvas.create_line(old_x, old_y, x, y, width=size, fill=color, capstyle=tk.ROUND, smooth=tk.TRUE)
-                elif message_type == CLEAR:
-                    self.canvas.delete("all")
-                elif message_type == PEER:
-                    new_peers = payload
-                    for name, addr in new_peers.items():
-                        if addr != (self.ip, self.port) and name not in self.peer_map:
-                            self.peer_map[name] = addr
-                            self.update_peers_list()
+        self.board.clear()
+        self.batcher.reset()
+        self.renderer.clear()
+        self.undo_stack.clear()
+        self.redo_stack.clear()
+        self.send_to_peers(encode(CLEAR, self.board.cleared))
+        self.log(CLEAR, self.board.cleared)
+
+    # Per-stroke edits: each one is a single tombstone, whatever the size of the board
+    def set_stroke_removed(self, stroke_id, removed):
+        if stroke_id not in self.board.strokes:
+            return
+        if self.board.set_removed(stroke_id, removed):
+            self.show_removed(stroke_id, removed)
+        entry = [self.board.tombstone(stroke_id)]
+        self.send_to_peers(encode(TOMBSTONE, entry))
+        self.log(TOMBSTONE, entry)
+
+    def show_removed(self, stroke_id, removed):
+        if removed:
+            self.renderer.remove_stroke(stroke_id)
+        elif stroke_id in self.board.strokes:
+            self.renderer.push_stroke(self.board.strokes[stroke_id])
+
+    def undo(self, event=None):
+        self.end_stroke()
+        while self.undo_stack:
+            stroke_id, removed = self.undo_stack.pop()
+            if stroke_id in self.board.strokes:                 # Skip strokes a clear has taken away
+                self.set_stroke_removed(stroke_id, not removed)
+                self.redo_stack.append((stroke_id, removed))
+                return
+
+    def redo(self, event=None):
+        while self.redo_stack:
+            stroke_id, removed = self.redo_stack.pop()
+            if stroke_id in self.board.strokes:
+                self.set_stroke_removed(stroke_id, removed)
+                self.undo_stack.append((stroke_id, removed))
+                return
+
+    def toggle_eraser(self):
+        self.end_stroke()
+        self.erasing = not self.erasing
+        self.eraser_button['relief'] = tk.SUNKEN if self.erasing else tk.RAISED
+
+    def erase(self, event):
+        # Removes the topmost stroke under the pointer, anyone's stroke can be erased
+        if not self.erasing:
+            return
+        stroke_id = self.renderer.stroke_at(event.x, event.y)
+        if stroke_id is not None:
+            self.set_stroke_removed(stroke_id, True)
+            self.undo_stack.append((stroke_id, True))
+            self.redo_stack.clear()
+
+    def open_session(self):
+        path = filedialog.askopenfilename(title="Open Session", initialdir=SESSION_DIR, filetypes=[("Whiteboard sessions", "*.wblog")])
+        if path:
+            self.load_session(path)
+
+    def load_session(self, path):
+        # Replace the board with the one saved in a session log and share it with the room
+        try:
+            reader = SessionReader(path)
+            loaded = reader.board_at(author=self.user_name)
+            reader.close()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to open session: {e}")
+            return
+        self.clear_canvas()
+        strokes = []
+        for old in loaded:
+            # Drawn again as our own strokes, stamped after the clear above
+            stroke = self.board.begin_stroke(old.color, old.width, old.points[0], old.points[1])
+            stroke.write(0, old.points)
+            strokes.append(stroke)
+            self.renderer.push_stroke(stroke)
+        self.compress_and_send(list(snapshot_parts(self.board, strokes)), [], self.send_to_peers)
+        if self.session_log:
+            self.session_log.append_strokes(strokes)
+
+    def export_board(self):
+        path = filedialog.asksaveasfilename(title="Export Board", defaultextension=".png", filetypes=[("PNG image", "*.png"), ("SVG image", "*.svg")])
+        if path:
+            # Rasterizing a big board takes a while, the window stays usable meanwhile
+            self.offload.submit(export_bytes, self.board.to_bytes(list(self.board)), path, background=self.canvas['bg'],
+                                callback=lambda path: print(f"Exported {path}"),
+                                error=lambda e: messagebox.showerror("Error", f"Failed to export: {e}"))
+
+    def send_snapshot(self, peer_id, version, sync_end=False):
+        # The board (or what changed since version) for one peer, see sync.py
+        head, parts = catch_up_plan(self.board, version)
+        tail = [encode(SYNC_END, self.board.version)] if sync_end else []
+        for frame in head:
+            self.net.send(peer_id, frame)
+        self.compress_and_send(parts, tail, lambda frame: self.net.send(peer_id, frame))
+
+    def compress_and_send(self, parts, tail, send):
+        # Snapshot parts go out compressed, then the tail frames, in that order
+        def done(compressed):
+            for data in compressed:
+                send(encode(SNAPSHOT, data))
+            for frame in tail:
+                send(frame)
+        def failed(error):
+            # A dead worker must not stall the sync, compress here instead
+            print(f"Offloaded compression failed, compressing inline: {error}")
+            done([compress_part(raw) for raw in parts])
+        if sum(map(len, parts)) < OFFLOAD_MIN_BYTES:
+            done([compress_part(raw) for raw in parts])
+        else:
+            self.offload.map(compress_part, parts, done, error=failed)
+
+    def on_close(self):
+        self.offload.shutdown()
+        if self.announcer:
+            self.announcer.stop()
+        if self.session_log:
+            self.session_log.close()
+        self.master.destroy()
+
+    def receive_data(self):
+        # Runs on the Tk thread every POLL_MS and handles a bounded number of network
+        # events so a burst of traffic cannot freeze the window
+        started = time.perf_counter()
+        handled = 0
+        try:
+            while handled < MAX_EVENTS_PER_POLL:
+                event, peer_id, *details = self.net.inbox.get_nowait()
+                handled += 1
+                if event == MESSAGE:
+                    message_type, payload = details[0]
+                    with self.metrics.timer(f"handle_{message_type}"):
+                        self.handle_message(peer_id, message_type, payload)
+                elif event == CONNECTED:
+                    addr, outgoing = details
+                    if outgoing:
+                        self.dialed.add(addr)
+                        self.register_peer(peer_id, addr)
+                elif event == CLOSED:
+                    self.peer_lost(peer_id, details[0])
+                elif event == CONNECT_FAILED:
+                    addr, error = details[0]
+                    self.connecting.discard(addr)
+                    print(f"Failed to connect to peer {addr[0]}:{addr[1]}: {error}")
+                    if addr in self.reconnecting:
+                        self.schedule_reconnect(addr)
+        except queue.Empty:
+            pass
+        except Exception as e:
+            self.metrics.inc("receive_errors")
+            print(f"Connection error: {e}")
+        if handled:
+            self.metrics.observe("receive_data", time.perf_counter() - started)
+        self.master.after(POLL_MS, self.receive_data)
+
+    def register_peer(self, peer_id, addr, resume=False):
+        # resume: the peer did not ask for a snapshot, catch up with it if it was here before
+        self.connecting.discard(addr)
+        self.peer_addrs[peer_id] = addr
+        if peer_id not in self.peers:
+            self.peers.append(peer_id)
+            if self.announcer:
+                self.announcer.notify()                     # Room size changed, tell the network now
+            introduced = self.introduced.pop(addr, None)
+            if self.reconnecting.pop(addr, None) is not None or (resume and addr in self.marks):
+                print(f"Resuming with peer at {addr[0]}:{addr[1]}")
+                self.net.send(peer_id, encode(SYNC_ACK, self.marks.get(addr, 0)))    # Ask for what changed since its last ping
+            elif introduced is not None:
+                # Changes made while the link came up reached the host too late for the peer's catch-up
+                self.send_snapshot(peer_id, introduced)
+            stroke = self.batcher.stroke
+            if stroke is not None:
+                # The new peer missed the start of the stroke being drawn right now
+                self.net.send_strokes(peer_id, [(stroke.stroke_id, stroke.color, stroke.width, 0, stroke.points[:])])
+
+    def handle_message(self, peer_id, message_type, payload):
+        if message_type == DRAW:
+            for stroke_id, color, width, start, coords in payload:
+                stroke = self.board.apply_chunk(stroke_id, color, width, start, coords)
+                if stroke is not None:                                  # None: cleared or removed
+                    self.renderer.push_stroke(stroke)
+            self.log(DRAW, payload)
+        elif message_type == CLEAR:
+            survivors = self.board.clear(payload)                       # Strokes started concurrently with the clear stay
+            if self.batcher.stroke is not None and self.batcher.stroke.stroke_id not in self.board.strokes:
+                self.batcher.reset()
+            self.renderer.clear()
+            for stroke in survivors:
+                self.renderer.push_stroke(stroke)
+            self.undo_stack = [entry for entry in self.undo_stack if entry[0] in self.board.strokes]
+            self.redo_stack = [entry for entry in self.redo_stack if entry[0] in self.board.strokes]
+            self.log(CLEAR, payload)
+            if survivors and self.session_log:
+                self.session_log.append_strokes(survivors)              # Replay starts at the last clear, keep them after it
+        elif message_type == TOMBSTONE:
+            for stroke_id, stamp, removed in payload:
+                if self.board.set_removed(stroke_id, removed, stamp):
+                    self.show_removed(stroke_id, removed)
+            self.log(TOMBSTONE, payload)
+        elif message_type == HELLO:
+            peer_name, peer_ip, peer_port, sync = payload               # Handshake from a peer that connected to us
+            self.register_peer(peer_id, (peer_ip, peer_port), resume=not sync)
+            self.peer_map[peer_name] = (peer_ip, peer_port)             # Add the peer to the peer map
+            self.update_peers_list()                                    # Update the list of connected peers
+            print(f"Peer connected: {peer_name} ({peer_ip}:{peer_port})")
+            self.broadcast_peers()                                      # Broadcast the updated list of peers
+            if sync:
+                self.send_snapshot(peer_id, 0, sync_end=True)           # Late joiner: send the board drawn so far
+        elif message_type == SNAPSHOT:
+            strokes = apply_snapshot(self.board, payload)
+            for stroke in strokes:
+                self.renderer.push_stroke(stroke)                       # Rendered progressively by the render tick
+            if self.session_log:
+                self.session_log.append_strokes(strokes)
+        elif message_type == SYNC_END:
+            self.net.send(peer_id, encode(SYNC_ACK, payload))           # Ask for what changed while the snapshot was in flight
+        elif message_type == SYNC_ACK:
+            self.send_snapshot(peer_id, payload)
+        elif message_type == PING:
+            addr = self.peer_addrs.get(peer_id)
+            if addr is not None:
+                self.marks[addr] = payload                              # Everything the peer had up to this version reached us
+        elif message_type == GONE:
+            # Trust the sender for its own address (a relay speaking for its clients), and for
+            # other addresses only when we have no live connection to them ourselves
+            sender = self.peer_addrs.get(peer_id)
+            live = set(self.peer_addrs.values())
+            gone = {name: addr for name, addr in payload.items()
+                    if name != self.user_name and self.peer_map.get(name) == addr and (addr == sender or addr not in live)}
+            if gone:
+                self.forget_peers(gone)
+        elif message_type == PEER:
+            new_peers = payload
+            connected = set(self.peer_addrs.values()) | self.connecting
+            for name, addr in new_peers.items():
+                if addr != (self.ip, self.port) and name not in self.peer_map:
+                    self.peer_map[name] = addr
+                    self.update_peers_list()
+                    if addr not in connected:
+                        self.introduced.setdefault(addr, self.board.version)
+                        if (self.ip, self.port) < tuple(addr):      # Only one side of each pair dials
                             self.connect_to_peer(addr[0], addr[1])
-            except Exception as e:
-                print(f"Connection error: {e}")
-                break
-        conn.close()
-        if conn in self.peers:
-            self.peers.remove(conn)
+
+    def heartbeat(self):
+        # Queued behind everything sent so far, so a peer receiving it has all our changes up to this version
+        self.send_to_peers(encode(PING, self.board.version))
+        self.master.after(HEARTBEAT_MS, self.heartbeat)
+
+    def peer_lost(self, peer_id, reason):
+        addr = self.peer_addrs.pop(peer_id, None)
+        print(f"Peer disconnected: {addr} ({reason})")
+        if peer_id in self.peers:
+            self.peers.remove(peer_id)
+        self.peers_told.pop(peer_id, None)
+        if self.announcer:
+            self.announcer.notify()
+        if addr is None or addr in self.peer_addrs.values():
+            return                                                      # Never said HELLO, or still connected another way
+        gone = {name: peer_addr for name, peer_addr in self.peer_map.items() if peer_addr == addr and name != self.user_name}
+        if gone:
+            self.forget_peers(gone)
+            self.send_to_peers(encode(GONE, gone))                      # Let the others prune it without waiting for their own timeout
+        if addr in self.dialed and addr not in self.reconnecting:
+            self.reconnecting[addr] = 0
+            self.schedule_reconnect(addr)
+
+    def forget_peers(self, gone):
+        for name, addr in gone.items():
+            self.peer_map.pop(name, None)
+            self.introduced.pop(addr, None)
+        for told in self.peers_told.values():
+            for name in gone:
+                told.pop(name, None)                                    # Told again if it comes back
+        self.update_peers_list()
+
+    def schedule_reconnect(self, addr):
+        # Exponential backoff with jitter, so peers that lost the same host do not redial in lockstep
+        attempt = self.reconnecting[addr]
+        if attempt >= RECONNECT_ATTEMPTS:
+            print(f"Giving up on peer at {addr[0]}:{addr[1]}")
+            del self.reconnecting[addr]
+            self.dialed.discard(addr)
+            return
+        self.reconnecting[addr] = attempt + 1
+        delay = min(RECONNECT_BASE_MS * 2 ** attempt, RECONNECT_MAX_MS) * random.uniform(0.5, 1.0)
+        self.master.after(int(delay), lambda: self.redial(addr))
+
+    def redial(self, addr):
+        if addr not in self.reconnecting:
+            return
+        if addr in self.peer_addrs.values():
+            del self.reconnecting[addr]                                 # The peer dialed us in the meantime
+            return
+        self.connect_to_peer(addr[0], addr[1])
 
     def update_peers_list(self):
         self.peers_list.delete(0, tk.END)
@@ -255,12 +698,41 @@ class Whiteboard:
             self.peers_list.insert(tk.END, f"{name}")
 
     def broadcast_peers(self):
-        data = pickle.dumps((PEER, self.peer_map))
-        for peer in self.peers:
-            try:
-                peer.send(data)
-            except Exception as e:
-                print(f"Error sending peer list: {e}")
+        # Every peer is only sent the entries it has not been told about yet
+        with self.metrics.timer("broadcast_peers"):
+            for peer_id in self.peers:
+                told = self.peers_told.setdefault(peer_id, {})
+                fresh = {name: addr for name, addr in self.peer_map.items() if told.get(name) != addr}
+                if fresh:
+                    self.net.send(peer_id, encode(PEER, fresh))
+                    told.update(fresh)
+
+    def peer_stats(self):
+        # Network counters per connection, labelled with the peer's listening address
+        stats = {}
+        for peer_id, peer in self.net.peer_stats().items():
+            addr = self.peer_addrs.get(peer_id)
+            stats[f"{addr[0]}:{addr[1]}" if addr else f"peer{peer_id}"] = peer
+        return stats
+
+    def dump_metrics(self, path):
+        # JSON for .json files, Prometheus text otherwise
+        self.metrics.dump(path, self.peer_stats())
+
+    def toggle_stats(self):
+        if self.stats_panel:
+            self.stats_panel.destroy()
+            self.stats_panel = None
+            return
+        self.stats_panel = tk.Label(self.canvas, justify=tk.LEFT, anchor=tk.NW, font=("Courier", 9), bg="lightyellow", relief=tk.RIDGE, bd=1)
+        self.stats_panel.place(relx=1.0, x=-10, y=10, anchor=tk.NE)
+        self.update_stats()
+
+    def update_stats(self):
+        if not self.stats_panel:
+            return
+        self.stats_panel.config(text=self.metrics.summary(self.peer_stats()) or "No activity yet")
+        self.master.after(STATS_MS, self.update_stats)
 
     def choose_color(self):
         color = colorchooser.askcolor(color=self.brush_color)[1]
@@ -283,49 +755,31 @@ class Whiteboard:
         peer_ip, peer_port = shared_room_map[code]
         try:
             peer_port = int(peer_port)
-            peer_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            peer_sock.connect((peer_ip, peer_port))
-
-            data = pickle.dumps((self.user_name, self.ip, self.port))
-            peer_sock.send(data)
-
-            peer_data = peer_sock.recv(BUFFER_SIZE)
-            message_type, peer_list = pickle.loads(peer_data)
-            if message_type == PEER:
-                self.peer_map.update(peer_list)
-                self.update_peers_list()
-
-            self.peers.append(peer_sock)
+            hello = encode(HELLO, (self.user_name, self.ip, self.port, True))     # Joining a room: ask the host for the board
+            peer_id = self.net.connect(peer_ip, peer_port, hello).result(timeout=CONNECT_TIMEOUT)   # Wait here so a bad code can be reported
+            self.register_peer(peer_id, (peer_ip, peer_port))
             self.update_peers_list()
             print(f"Connected to peer at {peer_ip}:{peer_port}")
 
             self.broadcast_peers()
-            threading.Thread(target=self.receive_data, args=(peer_sock,), daemon=True).start()
         except Exception as e:
             messagebox.showerror("Error", f"Failed to connect to peer: {e}")
 
 
     def connect_to_peer(self, peer_ip, peer_port):
-        try:
-            peer_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            peer_sock.connect((peer_ip, peer_port))
-
-            # Send this user's name and listening port to the peer during the handshake
-            data = pickle.dumps((self.user_name, self.ip, self.port))
-            peer_sock.send(data)
-
-            self.peers.append(peer_sock)
-            self.update_peers_list()
-            print(f"Automatically connected to peer at {peer_ip}:{peer_port}")
-
-            threading.Thread(target=self.receive_data, args=(peer_sock,), daemon=True).start()
-        except Exception as e:
-            print(f"Failed to connect to peer {peer_ip}:{peer_port}: {e}")
+        # Non-blocking: the result arrives as a CONNECTED or CONNECT_FAILED event
+        self.connecting.add((peer_ip, peer_port))
+        self.net.connect(peer_ip, peer_port, encode(HELLO, (self.user_name, self.ip, self.port, False)))
+        print(f"Connecting to peer at {peer_ip}:{peer_port}")
 
 
 # Entry point for the program
 if __name__ == "__main__":
-    
+
+    if sys.argv[1:2] == ["relay"]:                                          # python MAIN_CODE.py relay [--room CODE]: headless hub, no window
+        relay.main(sys.argv[2:])
+        sys.exit()
+
     ip = socket.gethostbyname(socket.gethostname())                         # Get the IP address of the host
     port = 0                                                                # Set the port number to 0
     user_name = simpledialog.askstring("Name", "Enter your name:")          # Prompt the user to enter their name
@@ -338,59 +792,75 @@ if __name__ == "__main__":
 
 
     def main_menu():
+        listener = DiscoveryListener()                                                                  # Collects room announcements while the menu is open
+        listener.query()                                                                                # Ask running rooms to announce themselves now
+
         def create_room():
+            listener.close()
             room_code = generate_room_code()                                                            # Generate a random room code
             root.destroy()                                                                              # Close the main menu window
             whiteboard_root = tk.Tk()                                                                   # Create a new Tkinter window for the whiteboard 
-            app = Whiteboard(whiteboard_root, ip, port, user_name, is_host=True, room_code=room_code)   # Initialize the whiteboard
+            app = Whiteboard(whiteboard_root, ip, port, user_name, is_host=True, room_code=room_code, session_file=session_path(user_name))   # Initialize the whiteboard
             whiteboard_root.mainloop()                                                                  # Start the whiteboard
 
         def join_room():
-            # Create a temporary socket to listen for room maps
-            listen_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)                              # Create a UDP socket
-            listen_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)                           # Set the socket option to reuse the address
-            listen_sock.bind(('', BROADCAST_PORT))                                                      # Bind the socket to the broadcast port to collect room maps
-
-            shared_room_map = {}                                                                        # Dictionary to store the room maps
-
-            def listen_for_maps():
-                # Thread to listen for broadcasted room maps
-                while True:
-                    try:
-                        data, addr = listen_sock.recvfrom(BUFFER_SIZE)                                  
-                        message_type, payload = pickle.loads(data)
-                        if message_type == MAP:
-                            shared_room_map.update(payload)
-                    except Exception as e:
-                        print(f"Error receiving map: {e}")
-
-            threading.Thread(target=listen_for_maps, daemon=True).start()
+            shown = []                                                                                  # Room codes in the order they are listed
+            refresh_job = [None]                                                                        # Pending after() id of the next refresh
+
+            def refresh_rooms():
+                # Redraw the list from the directory cache, keeping the selection
+                selection = rooms_list.curselection()
+                selected = shown[selection[0]] if selection else None
+                rooms = listener.directory.live()
+                shown[:] = [room.code for room in rooms]
+                rooms_list.delete(0, tk.END)
+                for room in rooms:
+                    rooms_list.insert(tk.END, f"{room.code}    {room.peers or '?'} in room    load {room.load}%")
+                if selected in shown:
+                    rooms_list.selection_set(shown.index(selected))
+                refresh_job[0] = join_root.after(ROOM_LIST_MS, refresh_rooms)
+
+            def open_room(room_code):
+                room = listener.directory.lookup(room_code)                                             # Answered from the cache, never waits on the network
+                if room is None:
+                    messagebox.showerror("Error", "Invalid Room Code.")
+                    return
+                try:
+                    # Close the join menu and open the whiteboard
+                    join_root.after_cancel(refresh_job[0])
+                    join_root.destroy()
+                    listener.close()
+
+                    # Initialize the whiteboard on the main thread
+                    whiteboard_root = tk.Tk()
+                    app = Whiteboard(whiteboard_root, ip, port, user_name, is_host=False, room_code=room_code, session_file=session_path(user_name))
+                    app.manual_connect(room_code, {room_code: room.addr})
+                    whiteboard_root.mainloop()
+                except Exception as e:
+                    messagebox.showerror("Error", f"Failed to open whiteboard: {e}")
+
+            def join_selected(event=None):
+                selection = rooms_list.curselection()
+                if selection:
+                    open_room(shown[selection[0]])
 
             def prompt_for_code():
                 # Prompt the user to enter the room code
                 room_code = simpledialog.askstring("Room Code", "Enter the Room Code:")
-                if room_code in shared_room_map:
-                    # Get the peer address from the shared room map
-                    peer_ip, peer_port = shared_room_map[room_code]
-                    try:
-                        # Close the join menu and open the whiteboard
-                        join_root.destroy()
-
-                        # Initialize the whiteboard on the main thread
-                        whiteboard_root = tk.Tk()
-                        app = Whiteboard(whiteboard_root, ip, port, user_name, is_host=False, room_code=room_code)
-                        app.manual_connect(room_code, shared_room_map)
-                        whiteboard_root.mainloop()
-                    except Exception as e:
-                        messagebox.showerror("Error", f"Failed to open whiteboard: {e}")
-                else:
-                    messagebox.showerror("Error", "Invalid Room Code.")
+                if room_code:
+                    open_room(room_code.strip())
 
             # Create the GUI for joining a room
             root.destroy()
             join_root = tk.Tk()
             join_root.title("Join Room")
-            tk.Button(join_root, text="Enter Room Code", command=prompt_for_code).pack(pady=20)
+            tk.Label(join_root, text="Live Rooms:", font=("Comic Sans MS", 10, "bold")).pack(pady=(10, 0))
+            rooms_list = tk.Listbox(join_root, height=8, width=40, bg="lightblue", fg="black", font=("Comic Sans MS", 10, "bold"), relief=tk.RAISED, bd=2)
+            rooms_list.pack(padx=10, pady=5)
+            rooms_list.bind("<Double-Button-1>", join_selected)
+            tk.Button(join_root, text="Join Selected Room", command=join_selected).pack(pady=5)
+            tk.Button(join_root, text="Enter Room Code", command=prompt_for_code).pack(pady=(5, 20))
+            refresh_rooms()
             join_root.mainloop()
 
 
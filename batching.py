@@ -0,0 +1,112 @@
+# Knobs for the latency / bandwidth trade-off of outgoing strokes
+MAX_LATENCY_MS = 50         # A point waits at most this long before it is sent
+MAX_BATCH_BYTES = 512       # Flush early once the pending points would take about this much
+SIMPLIFY_TOLERANCE = 0.75   # Ramer-Douglas-Peucker tolerance in pixels, 0 sends every point
+BYTES_PER_POINT = 2         # Rough wire cost of one delta-encoded point, used for the byte budget
+
+
+def simplify(coords, tolerance=SIMPLIFY_TOLERANCE):
+    # Ramer-Douglas-Peucker on flat x, y coordinates. Keeps the first and last point
+    # and every point further than tolerance from the line through its neighbours
+    count = len(coords) // 2
+    if count < 3 or tolerance <= 0:
+        return list(coords)
+    keep = [False] * count
+    keep[0] = keep[-1] = True
+    tolerance_sq = tolerance * tolerance
+    stack = [(0, count - 1)]
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = coords[first * 2], coords[first * 2 + 1]
+        x2, y2 = coords[last * 2], coords[last * 2 + 1]
+        dx, dy = x2 - x1, y2 - y1
+        length_sq = dx * dx + dy * dy
+        worst, worst_dist = 0, tolerance_sq
+        for i in range(first + 1, last):
+            px, py = coords[i * 2] - x1, coords[i * 2 + 1] - y1
+            if length_sq:
+                cross = px * dy - py * dx
+                dist = cross * cross / length_sq
+            else:
+                dist = px * px + py * py
+            if dist > worst_dist:
+                worst, worst_dist = i, dist
+        if worst:
+            keep[worst] = True
+            stack.append((first, worst))
+            stack.append((worst, last))
+    simplified = []
+    for i in range(count):
+        if keep[i]:
+            simplified.append(coords[i * 2])
+            simplified.append(coords[i * 2 + 1])
+    return simplified
+
+
+class StrokeBatcher:
+    # Collects the raw mouse points of the local stroke and decides when to send them:
+    # after MAX_LATENCY_MS, once MAX_BATCH_BYTES worth of points are pending, or when
+    # the stroke ends. Pending points are simplified before they are written to the
+    # board, so the board always holds exactly what the peers receive.
+
+    def __init__(self, board, send, master, max_latency_ms=MAX_LATENCY_MS, max_bytes=MAX_BATCH_BYTES, tolerance=SIMPLIFY_TOLERANCE):
+        self.board = board
+        self.send = send                # Called with one DRAW chunk (stroke_id, color, width, start, coords)
+        self.master = master
+        self.max_latency_ms = max_latency_ms
+        self.max_bytes = max_bytes
+        self.tolerance = tolerance
+        self.stroke = None
+        self.pending = []               # Raw points received since the last flush
+        self.sent = 0                   # Points of the stroke already sent to peers
+        self.after_id = None
+
+    def begin(self, color, width, x, y):
+        self.end()
+        self.stroke = self.board.begin_stroke(color, width, x, y)
+        self.sent = 0
+        return self.stroke
+
+    def add_point(self, x, y):
+        if self.stroke is None:
+            return
+        self.pending.append(x)
+        self.pending.append(y)
+        if len(self.pending) // 2 * BYTES_PER_POINT >= self.max_bytes:
+            self.flush()
+        elif self.after_id is None:
+            self.after_id = self.master.after(self.max_latency_ms, self.flush)
+
+    def flush(self):
+        if self.after_id is not None:
+            self.master.after_cancel(self.after_id)
+            self.after_id = None
+        stroke = self.stroke
+        if stroke is None:
+            return
+        if self.pending:
+            # The last point already on the board anchors the simplification, so the
+            # new run joins the previous one without a visible kink
+            anchor = list(stroke.points[-2:])
+            kept = simplify(anchor + self.pending, self.tolerance)[2:]
+            stroke.write(stroke.point_count(), kept)
+            self.pending = []
+            self.board.touch(stroke)
+        if stroke.point_count() > self.sent:
+            self.send((stroke.stroke_id, stroke.color, stroke.width, self.sent, stroke.points[self.sent * 2:]))
+            self.sent = stroke.point_count()
+
+    def end(self):
+        # Sends the tail of the stroke, returns the finished stroke
+        stroke = self.stroke
+        self.flush()
+        self.stroke = None
+        return stroke
+
+    def reset(self):
+        # The board was cleared under the stroke being drawn, forget it without sending
+        if self.after_id is not None:
+            self.master.after_cancel(self.after_id)
+            self.after_id = None
+        self.stroke = None
+        self.pending = []
@@ -0,0 +1,108 @@
+# Bytes per stroke: old fixed 10-segment pickle batches vs StrokeBatcher
+#
+#   python benchmarks/bench_batching.py [strokes]
+#
+# Synthetic mouse strokes (curves sampled at 125 events per second, like <B1-Motion>)
+# are fed through each sender on a simulated clock, and every frame that would go on
+# the wire is measured. The StrokeBatcher rows show a few latency / tolerance settings.
+
+import math
+import os
+import pickle
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batching import StrokeBatcher
+from board import Board
+from protocol import DRAW, encode
+
+EVENT_MS = 8    # Time between two motion events
+
+
+class SimulatedMaster:
+    # Just enough of Tk's after()/after_cancel() to drive the batcher on a fake clock
+
+    def __init__(self):
+        self.now = 0
+        self.timers = {}
+        self.next_id = 0
+
+    def after(self, ms, callback):
+        self.next_id += 1
+        self.timers[self.next_id] = (self.now + ms, callback)
+        return self.next_id
+
+    def after_cancel(self, after_id):
+        self.timers.pop(after_id, None)
+
+    def advance(self, ms):
+        self.now += ms
+        for after_id, (due, callback) in sorted(self.timers.items(), key=lambda item: item[1][0]):
+            if due <= self.now and after_id in self.timers:
+                del self.timers[after_id]
+                callback()
+
+
+def make_strokes(count, seed=1):
+    rng = random.Random(seed)
+    strokes = []
+    for _ in range(count):
+        cx, cy = rng.uniform(100, 700), rng.uniform(100, 500)
+        radius, turns = rng.uniform(20, 200), rng.uniform(0.3, 1.5)
+        steps = rng.randint(40, 300)
+        points = []
+        for i in range(steps):
+            angle = turns * 2 * math.pi * i / steps
+            wobble = 1 + 0.2 * math.sin(angle * 3)
+            points.append((int(cx + radius * wobble * math.cos(angle)), int(cy + radius * wobble * math.sin(angle))))
+        strokes.append(points)
+    return strokes
+
+
+def old_sender(strokes):
+    # Baseline draw(): a pickled list of 10 segment tuples per batch, tail never sent
+    frames = []
+    for points in strokes:
+        batch = []
+        for (old_x, old_y), (x, y) in zip(points, points[1:]):
+            batch.append((old_x, old_y, x, y, "black", 2))
+            if len(batch) >= 10:
+                frames.append(pickle.dumps((DRAW, batch)))
+                batch = []
+    return frames
+
+
+def batcher_sender(strokes, **knobs):
+    frames = []
+    master = SimulatedMaster()
+    batcher = StrokeBatcher(Board("bench"), lambda chunk: frames.append(encode(DRAW, [chunk])), master, **knobs)
+    for points in strokes:
+        batcher.begin("black", 2, *points[0])
+        for x, y in points[1:]:
+            master.advance(EVENT_MS)
+            batcher.add_point(x, y)
+        batcher.end()
+    return frames
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    strokes = make_strokes(count)
+    points = sum(len(stroke) for stroke in strokes)
+    print(f"{count} strokes, {points / count:.0f} points per stroke on average\n")
+    print(f"{'sender':<36}{'bytes/stroke':>14}{'frames/stroke':>15}{'ratio':>8}")
+
+    baseline = sum(len(frame) for frame in old_sender(strokes))
+    rows = [("pickle, 10 segments per batch", old_sender(strokes))]
+    for latency, tolerance in ((16, 0), (50, 0.75), (50, 1.5), (100, 1.5)):
+        name = f"batcher, {latency}ms, tolerance {tolerance}"
+        rows.append((name, batcher_sender(strokes, max_latency_ms=latency, tolerance=tolerance)))
+    for name, frames in rows:
+        size = sum(len(frame) for frame in frames)
+        print(f"{name:<36}{size / count:>14.0f}{len(frames) / count:>15.1f}{baseline / size:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
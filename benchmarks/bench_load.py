@@ -0,0 +1,327 @@
+# Load and latency benchmark: N simulated peers in one process, no display needed
+#
+#   python benchmarks/bench_load.py [--peers 2,4,8,16] [--drawers 2] [--seconds 5]
+#                                   [--relay] [--trace SESSION.wblog]
+#                                   [--json RESULT.json] [--baseline BASELINE.json]
+#
+# Every peer is a real Whiteboard with its widgets replaced: the networking paths
+# (start_server, manual_connect, connect_to_peer, receive_data, handle_message, the
+# StrokeBatcher and the NetworkEngine) are the application's own, while after() is
+# served by a small scheduler instead of the Tk main loop and drawing goes to a
+# renderer that only counts. Peers join the first one with its room code and build
+# the mesh themselves, or all join a relay with --relay.
+#
+# A few peers then draw strokes (synthetic random walks, or the strokes of a recorded
+# session with --trace) at mouse rate. Stroke latency is measured from the moment a
+# point is drawn to the moment another peer has applied it to its board. Each peer
+# count prints latency percentiles, messages and bytes per second, CPU time and RSS;
+# --json saves the rows and --baseline compares against a saved run. Bytes per second
+# counts what the peers put on the wire, so with --relay it excludes the hub's fan-out.
+
+import argparse
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import resource
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import MAIN_CODE
+import relay
+from protocol import DRAW
+from session_log import SessionReader
+
+ROOM_CODE = "BENCH1"
+EVENT_MS = 8            # Time between two motion events while drawing (125 Hz mouse)
+STROKE_GAP_MS = 150     # Pause between two strokes of one drawer
+JOIN_TIMEOUT = 10       # Seconds allowed for every peer to be connected
+SETTLE_SECONDS = 1      # Time given to the last frames after drawing stops
+
+
+class Scheduler:
+    # Stands in for the Tk main loop: after() callbacks of every peer run from run()
+
+    def __init__(self):
+        self.timers = []
+        self.ids = itertools.count(1)
+        self.cancelled = set()
+
+    def after(self, ms, callback, *args):
+        after_id = next(self.ids)
+        heapq.heappush(self.timers, (time.perf_counter() + ms / 1000, after_id, callback, args))
+        return after_id
+
+    def after_cancel(self, after_id):
+        self.cancelled.add(after_id)
+
+    def run(self, seconds, until=None):
+        deadline = time.perf_counter() + seconds
+        while time.perf_counter() < deadline and not (until and until()):
+            now = time.perf_counter()
+            if self.timers and self.timers[0][0] <= now:
+                _, after_id, callback, args = heapq.heappop(self.timers)
+                if after_id in self.cancelled:
+                    self.cancelled.discard(after_id)
+                else:
+                    callback(*args)
+            else:
+                time.sleep(min(self.timers[0][0] - now if self.timers else 0.001, 0.001))
+
+
+class CountingRenderer:
+    # Accepts what the Whiteboard would draw and only counts it
+
+    def __init__(self):
+        self.pushed = 0
+
+    def push_stroke(self, stroke):
+        self.pushed += 1
+
+    def show_stroke(self, stroke):
+        self.pushed += 1
+
+    def clear(self):
+        pass
+
+
+class ConsoleMessages:
+    # messagebox replacement, errors go to stderr instead of a dialog
+
+    @staticmethod
+    def showerror(title, message):
+        print(f"{title}: {message}", file=sys.stderr)
+
+
+class Stats:
+    def __init__(self):
+        self.sent_at = {}           # (stroke_id, end point) -> perf_counter of its oldest point
+        self.latencies = []
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.messages = 0
+
+
+class SimulatedPeer(MAIN_CODE.Whiteboard):
+    # A Whiteboard without a window: same networking state and methods, no widgets
+
+    def __init__(self, scheduler, ip, user_name, stats):
+        self.master = scheduler
+        self.stats = stats
+        self.init_state(ip, 0, user_name, offload_workers=0)       # Offloaded jobs run inline, results still come back through after()
+        self.renderer = CountingRenderer()
+        self.input_since = None     # When the oldest point not yet sent was drawn
+        self.start_networking()
+
+    def update_peers_list(self):
+        pass
+
+    def draw_point(self, x, y, first):
+        if self.input_since is None:
+            self.input_since = time.perf_counter()
+        if first:
+            self.batcher.begin("black", 2, x, y)
+        else:
+            self.batcher.add_point(x, y)
+
+    def send_draw_chunk(self, chunk):
+        stroke_id, _, _, start, coords = chunk
+        self.stats.sent_at[(stroke_id, start + len(coords) // 2)] = self.input_since
+        self.input_since = None
+        super().send_draw_chunk(chunk)
+
+    def handle_message(self, peer_id, message_type, payload):
+        self.stats.messages += 1
+        super().handle_message(peer_id, message_type, payload)
+        if message_type == DRAW:
+            now = time.perf_counter()
+            for stroke_id, _, _, start, coords in payload:
+                sent = self.stats.sent_at.get((stroke_id, start + len(coords) // 2))
+                if sent is not None:
+                    self.stats.latencies.append(now - sent)
+
+    def close(self):
+        self.net.stop()
+
+
+def synthetic_strokes(seed=1):
+    rng = random.Random(seed)
+    while True:
+        x, y = rng.randint(0, 1000), rng.randint(0, 800)
+        heading = rng.uniform(0, 6.28)
+        points = []
+        for _ in range(rng.randint(20, 120)):
+            heading += rng.uniform(-0.3, 0.3)
+            x += round(4 * math.cos(heading))
+            y += round(4 * math.sin(heading))
+            points.append((x, y))
+        yield points
+
+
+def trace_strokes(path):
+    reader = SessionReader(path)
+    strokes = [list(zip(s.points[0::2], s.points[1::2])) for s in reader.board_at() if s.point_count() > 1]
+    reader.close()
+    if not strokes:
+        sys.exit(f"No strokes in {path}")
+    return itertools.cycle(strokes)
+
+
+def start_drawing(scheduler, peer, strokes):
+    # Feeds one stroke at a time, one point every EVENT_MS, like <B1-Motion>
+    state = {"points": iter(()), "first": True, "running": True}
+
+    def step():
+        if not state["running"]:
+            return
+        point = next(state["points"], None)
+        if point is None:
+            if not state["first"]:
+                peer.batcher.end()
+            state["points"], state["first"] = iter(next(strokes)), True
+            scheduler.after(STROKE_GAP_MS, step)
+            return
+        peer.draw_point(point[0], point[1], state["first"])
+        state["first"] = False
+        scheduler.after(EVENT_MS, step)
+
+    scheduler.after(0, step)
+    return state
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def sent_totals(peers):
+    # Frames and bytes the peers' engines have written so far, as measured on the sockets
+    connections = [stats for peer in peers for stats in peer.net.peer_stats().values()]
+    return sum(c["frames_out"] for c in connections), sum(c["bytes_out"] for c in connections)
+
+
+def run(count, drawers, seconds, use_relay, make_strokes, ip="127.0.0.1", metrics_file=None):
+    scheduler = Scheduler()
+    stats = Stats()
+    hub = None
+    peers = [SimulatedPeer(scheduler, ip, f"peer{i}", stats) for i in range(count)]
+    if use_relay:
+        hub = relay.Relay(ip, 0)
+        hub_thread = threading.Thread(target=hub.serve_forever, daemon=True)
+        hub_thread.start()
+        room_map, joiners, expected = {ROOM_CODE: (ip, hub.port)}, peers, 1
+    else:
+        room_map, joiners, expected = {ROOM_CODE: (ip, peers[0].port)}, peers[1:], count - 1
+    for peer in joiners:
+        peer.manual_connect(ROOM_CODE, room_map)
+        scheduler.run(0.01)
+    joined = lambda: all(len(p.peers) >= expected for p in peers)
+    scheduler.run(JOIN_TIMEOUT, until=joined)
+    if not joined():
+        print(f"warning: only {sum(len(p.peers) for p in peers)} of {count * expected} connections up", file=sys.stderr)
+
+    cpu, wall = time.process_time(), time.perf_counter()
+    sent = sent_totals(peers)
+    drawing = [start_drawing(scheduler, peer, make_strokes(i)) for i, peer in enumerate(peers[:drawers])]
+    scheduler.run(seconds)
+    for state in drawing:
+        state["running"] = False
+    for peer in peers[:drawers]:
+        peer.batcher.end()
+    scheduler.run(SETTLE_SECONDS)
+    cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+    stats.frames_sent, stats.bytes_sent = (after - before for after, before in zip(sent_totals(peers), sent))
+    segments = {peer.board.segment_count() for peer in peers}
+
+    result = {
+        "peers": count,
+        "relay": use_relay,
+        "drawers": drawers,
+        "latency_p50_ms": percentile(stats.latencies, 0.5) * 1000,
+        "latency_p90_ms": percentile(stats.latencies, 0.9) * 1000,
+        "latency_p99_ms": percentile(stats.latencies, 0.99) * 1000,
+        "latency_max_ms": max(stats.latencies, default=float("nan")) * 1000,
+        "messages_per_s": stats.messages / wall,
+        "frames_sent_per_s": stats.frames_sent / wall,
+        "bytes_sent_per_s": stats.bytes_sent / wall,
+        "cpu_s": cpu,
+        "rss_mb": rss_bytes() / 2 ** 20,
+        "converged": len(segments) == 1,
+    }
+    if metrics_file:
+        peers[0].dump_metrics(metrics_file)
+    for peer in peers:
+        peer.close()
+    if hub:
+        hub.running = False
+        hub_thread.join(timeout=10)         # Its stop() closes the relay's connections
+    return result
+
+
+# (result key, header, width, format)
+COLUMNS = [("peers", "peers", 5, ""), ("latency_p50_ms", "p50 ms", 8, ".1f"), ("latency_p90_ms", "p90 ms", 8, ".1f"),
+           ("latency_p99_ms", "p99 ms", 8, ".1f"), ("messages_per_s", "msgs/s", 9, ".0f"), ("bytes_sent_per_s", "bytes/s", 11, ".0f"),
+           ("cpu_s", "cpu s", 7, ".2f"), ("rss_mb", "rss MB", 7, ".1f"), ("converged", "ok", 5, "")]
+
+
+def print_row(row, baseline=None):
+    print("  ".join(f"{str(row[key]) if not fmt else format(row[key], fmt):>{width}}" for key, _, width, fmt in COLUMNS))
+    if baseline:
+        deltas = []
+        for key in ("latency_p50_ms", "latency_p99_ms", "messages_per_s", "bytes_sent_per_s", "cpu_s"):
+            if baseline.get(key):
+                deltas.append(f"{key} {100 * (row[key] - baseline[key]) / baseline[key]:+.0f}%")
+        print("       vs baseline: " + ", ".join(deltas))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless load and latency benchmark for the whiteboard network paths.")
+    parser.add_argument("--peers", default="2,4,8", help="comma separated peer counts to run (default: 2,4,8)")
+    parser.add_argument("--drawers", type=int, default=2, help="peers drawing at the same time (default: 2)")
+    parser.add_argument("--seconds", type=float, default=5, help="drawing time per run (default: 5)")
+    parser.add_argument("--relay", action="store_true", help="join everyone to a relay instead of building a mesh")
+    parser.add_argument("--trace", default=None, help="session log whose strokes are replayed instead of random ones")
+    parser.add_argument("--json", default=None, help="write the results to this file")
+    parser.add_argument("--baseline", default=None, help="compare against results saved with --json")
+    parser.add_argument("--metrics", default=None, help="dump the first peer's metrics of the last run (.json, otherwise Prometheus text)")
+    args = parser.parse_args()
+
+    MAIN_CODE.messagebox = ConsoleMessages
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {(row["peers"], row["relay"]): row for row in json.load(f)}
+    if args.trace:
+        make_strokes = lambda i: trace_strokes(args.trace)
+    else:
+        make_strokes = lambda i: synthetic_strokes(seed=i + 1)
+
+    results = []
+    print(f"{'relay' if args.relay else 'mesh'}, {args.drawers} drawing, {args.seconds:g}s per run")
+    print("  ".join(f"{header:>{width}}" for _, header, width, _ in COLUMNS))
+    for count in [int(n) for n in args.peers.split(",")]:
+        row = run(count, min(args.drawers, count), args.seconds, args.relay, make_strokes, metrics_file=args.metrics)
+        results.append(row)
+        print_row(row, baseline.get((count, args.relay)))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# Throughput benchmark: framed binary codec vs the old pickle-per-recv path
+#
+#   python benchmarks/bench_protocol.py [batches]
+#
+# Both paths carry the same DRAW batches (10 points each, like Whiteboard.draw): the
+# pickle path as the old list of segment tuples, the framed path as a stroke chunk.
+# Two separate measurements:
+#   decode/s    throughput, every decoder is handed whole frames one at a time
+#   batches ok  robustness, the stream is cut into random recv()-sized chunks to
+#               mimic TCP splitting and coalescing, and we count how many batches
+#               each receive path recovers
+
+import os
+import pickle
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from protocol import DRAW, FrameDecoder, encode
+
+
+def make_batches(count, batch_size=10, seed=1):
+    # Returns (segment tuples, stroke chunk) pairs describing the same points
+    rng = random.Random(seed)
+    batches = []
+    x, y = 400, 300
+    for seq in range(count):
+        color = rng.choice(["black", "#ff0000", "#1e90ff"])
+        size = rng.randint(1, 10)
+        segments = []
+        coords = [x, y]
+        for _ in range(batch_size):
+            nx, ny = x + rng.randint(-5, 5), y + rng.randint(-5, 5)
+            segments.append((x, y, nx, ny, color, size))
+            coords.extend((nx, ny))
+            x, y = nx, ny
+        batches.append((segments, [(("bench", seq), color, size, 0, coords)]))
+    return batches
+
+
+def chunk(stream, seed=2, max_chunk=8192):
+    rng = random.Random(seed)
+    chunks = []
+    i = 0
+    while i < len(stream):
+        n = rng.randint(1, max_chunk)
+        chunks.append(stream[i:i + n])
+        i += n
+    return chunks
+
+
+def bench_pickle(batches):
+    start = time.perf_counter()
+    frames = [pickle.dumps((DRAW, segments)) for segments, chunk in batches]
+    encode_time = time.perf_counter() - start
+    stream = b"".join(frames)
+
+    start = time.perf_counter()
+    for frame in frames:
+        pickle.loads(frame)
+    decode_time = time.perf_counter() - start
+
+    # Old receive path: one recv() is assumed to be exactly one pickle
+    decoded = 0
+    for data in chunk(stream):
+        try:
+            message_type, payload = pickle.loads(data)
+            decoded += 1
+        except Exception:
+            pass
+    return len(stream), encode_time, decode_time, decoded
+
+
+def bench_framed(batches):
+    start = time.perf_counter()
+    frames = [encode(DRAW, chunk) for segments, chunk in batches]
+    encode_time = time.perf_counter() - start
+    stream = b"".join(frames)
+
+    decoder = FrameDecoder()
+    start = time.perf_counter()
+    for frame in frames:
+        decoder.feed(frame)
+    decode_time = time.perf_counter() - start
+
+    decoder = FrameDecoder()
+    decoded = 0
+    for data in chunk(stream):
+        decoded += len(decoder.feed(data))
+    return len(stream), encode_time, decode_time, decoded
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    batches = make_batches(count)
+    print(f"{count} DRAW batches of {len(batches[0][0])} segments\n")
+    print(f"{'codec':<8}{'bytes/batch':>12}{'encode/s':>12}{'decode/s':>12}{'batches ok':>16}")
+    print(f"{'':<8}{'':>12}{'':>12}{'(frames)':>12}{'(split stream)':>16}")
+    for name, bench in (("pickle", bench_pickle), ("framed", bench_framed)):
+        size, encode_time, decode_time, decoded = bench(batches)
+        print(f"{name:<8}{size / count:>12.1f}{count / encode_time:>12.0f}"
+              f"{count / decode_time:>12.0f}{decoded:>10}/{count}")
+
+
+if __name__ == "__main__":
+    main()
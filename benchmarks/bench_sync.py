@@ -0,0 +1,85 @@
+# Join-time benchmark: snapshot sync vs replaying every segment
+#
+#   python benchmarks/bench_sync.py [segments]
+#
+# Builds a board with the given number of segments (100k by default), then measures
+# how long a joiner on the loopback interface takes to hold the whole board, once with
+# the compressed SNAPSHOT/SYNC_END stream and once with one DRAW frame per segment (what
+# replaying the session segment by segment would cost).
+
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from board import Board
+from network import NetworkEngine, CONNECTED, MESSAGE
+from protocol import DRAW, SNAPSHOT, encode
+from sync import sync_frames, apply_snapshot
+
+
+def make_board(segments, points_per_stroke=50, seed=1):
+    rng = random.Random(seed)
+    board = Board("host")
+    while board.segment_count() < segments:
+        x, y = rng.randint(0, 800), rng.randint(0, 600)
+        stroke = board.begin_stroke(rng.choice(["black", "#ff0000", "#1e90ff"]), rng.randint(1, 10), x, y)
+        for _ in range(min(points_per_stroke, segments - board.segment_count())):
+            x, y = x + rng.randint(-4, 4), y + rng.randint(-4, 4)
+            board.add_point(stroke, x, y)
+    return board
+
+
+def replay_frames(board):
+    frames = []
+    for stroke in board:
+        points = stroke.points
+        for i in range(0, len(points) - 2, 2):
+            frames.append(encode(DRAW, [(stroke.stroke_id, stroke.color, stroke.width, i // 2, points[i:i + 4])]))
+    return frames
+
+
+def run_join(make_frames, board):
+    host, joiner = NetworkEngine(queue_size=10 ** 6).start(), NetworkEngine().start()
+    ip, port = host.listen("127.0.0.1", 0)
+    joiner.connect(ip, port).result()
+    while host.inbox.get()[0] != CONNECTED:
+        pass
+
+    received = Board("joiner")
+    start = time.perf_counter()
+    frames = make_frames(board)
+    host.broadcast(b"".join(frames))        # One write, the joiner still sees individual frames
+    remaining = len(frames)
+    while remaining:
+        event, _, *details = joiner.inbox.get()
+        if event != MESSAGE:
+            continue
+        remaining -= 1
+        message_type, payload = details[0]
+        if message_type == SNAPSHOT:
+            apply_snapshot(received, payload)
+        elif message_type == DRAW:
+            for chunk in payload:
+                received.apply_chunk(*chunk)
+    elapsed = time.perf_counter() - start
+    host.stop()
+    joiner.stop()
+    assert received.segment_count() == board.segment_count()
+    return elapsed, sum(len(frame) for frame in frames), len(frames)
+
+
+def main():
+    segments = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    board = make_board(segments)
+    print(f"Board: {len(board)} strokes, {board.segment_count()} segments\n")
+    print(f"{'method':<10}{'frames':>10}{'bytes':>12}{'join time':>12}")
+    for name, make_frames in (("snapshot", sync_frames), ("replay", replay_frames)):
+        elapsed, sent, frames = run_join(make_frames, board)
+        print(f"{name:<10}{frames:>10}{sent:>12}{elapsed * 1000:>10.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
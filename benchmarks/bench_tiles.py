@@ -0,0 +1,84 @@
+# Canvas item count and repaint time before and after tile flattening (Linux, needs X)
+#
+#   python benchmarks/bench_tiles.py [strokes]
+#   xvfb-run -a python benchmarks/bench_tiles.py      # on a machine without a display
+#
+# Fills a real Tk canvas with random strokes through RenderQueue, measures the time of
+# full repaints (every item moved by one pixel, then update_idletasks), lets the
+# TileCompositor flatten everything into tiles and measures again.
+
+import os
+import random
+import sys
+import time
+import tkinter as tk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tiles
+from board import Board
+from render import RenderQueue
+
+REPAINTS = 20
+
+
+def repaint_time(root, canvas):
+    root.update()
+    start = time.perf_counter()
+    for i in range(REPAINTS):
+        canvas.move("all", 1 if i % 2 == 0 else -1, 0)
+        root.update_idletasks()
+    return (time.perf_counter() - start) / REPAINTS * 1000
+
+
+def pump(root, until):
+    deadline = time.monotonic() + 120
+    while not until() and time.monotonic() < deadline:
+        root.update()
+        time.sleep(0.005)
+
+
+def main():
+    if sys.platform.startswith("linux") and not os.environ.get("DISPLAY"):
+        sys.exit("No X display: run under xvfb-run -a")
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+
+    root = tk.Tk()
+    canvas = tk.Canvas(root, bg="white", width=800, height=600)
+    canvas.pack()
+    renderer = RenderQueue(canvas)
+    renderer.tiles.settle_seconds = 0
+    tiles.FLATTEN_MIN_ITEMS = count + 1        # Hold flattening back until the vector numbers are taken
+    renderer.start(root)
+
+    rng = random.Random(1)
+    board = Board("bench")
+    for _ in range(count):
+        x, y = rng.randint(0, 800), rng.randint(0, 600)
+        stroke = board.begin_stroke(rng.choice(["black", "red", "#1e90ff"]), rng.randint(1, 6), x, y)
+        for _ in range(30):
+            x, y = x + rng.randint(-6, 6), y + rng.randint(-6, 6)
+            board.add_point(stroke, x, y)
+        renderer.push_stroke(stroke)
+    pump(root, lambda: not renderer.dirty)
+
+    before_items = len(canvas.find_all())
+    before = repaint_time(root, canvas)
+
+    tiles.FLATTEN_MIN_ITEMS = 0
+    start = time.perf_counter()
+    pump(root, lambda: not renderer.items)
+    flatten_time = time.perf_counter() - start
+    after_items = len(canvas.find_all())
+    after = repaint_time(root, canvas)
+
+    print(f"{count} strokes, {board.segment_count()} segments\n")
+    print(f"{'':<16}{'canvas items':>14}{'repaint':>12}")
+    print(f"{'vector':<16}{before_items:>14}{before:>10.2f}ms")
+    print(f"{'tiles':<16}{after_items:>14}{after:>10.2f}ms")
+    print(f"\nflattening took {flatten_time:.1f}s in the background")
+    root.destroy()
+
+
+if __name__ == "__main__":
+    main()
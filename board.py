@@ -0,0 +1,183 @@
+from array import array
+
+from protocol import encode_strokes, decode_strokes
+
+
+class Stroke:
+    # One continuous pen stroke. Points are stored flat (x0, y0, x1, y1, ...) in an
+    # int16 array, so a stroke costs a few bytes per point instead of a tuple per segment
+
+    __slots__ = ("stroke_id", "author", "color", "width", "points", "version")
+
+    def __init__(self, stroke_id, color, width, points=()):
+        self.stroke_id = stroke_id      # (author, sequence number), unique across the room
+        self.author = stroke_id[0]
+        self.color = color
+        self.width = width
+        self.points = array("h", points)
+        self.version = 0                # Board version of the last change to this stroke
+
+    def add_point(self, x, y):
+        self.points.append(x)
+        self.points.append(y)
+
+    def write(self, start, coords):
+        # Points have a fixed index in the stroke, so chunks that arrive twice (live and
+        # in a snapshot) or out of order end up in the same place
+        points = self.points
+        if start * 2 > len(points):
+            # Earlier points have not arrived yet, hold their place with the first new one
+            points.extend(array("h", coords[:2]) * (start - len(points) // 2))
+        if not isinstance(coords, array):
+            coords = array("h", coords)
+        points[start * 2:start * 2 + len(coords)] = coords
+
+    def point_count(self):
+        return len(self.points) // 2
+
+    def segment_count(self):
+        return max(self.point_count() - 1, 0)
+
+    def bbox(self):
+        xs, ys = self.points[0::2], self.points[1::2]
+        return min(xs), min(ys), max(xs), max(ys)
+
+
+class Board:
+    # Everything that is currently on the whiteboard, in drawing order.
+    #
+    # Edits are CRDT operations ordered by Lamport stamps (counter, site), so every
+    # peer ends up with the same board whatever order the mesh delivers them in:
+    #   - a stroke's sequence number is the Lamport counter at its creation, so its
+    #     id (author, seq) doubles as its stamp (seq, author)
+    #   - points are written at fixed indexes (Stroke.write), which commutes
+    #   - CLEAR(stamp) removes every stroke stamped before it, also ones that arrive
+    #     later; strokes started concurrently with a higher stamp survive it
+    #   - tombstones remove or restore a single stroke, the highest stamp wins
+    # Removed strokes keep their points so a redo anywhere can bring them back.
+
+    def __init__(self, author):
+        self.author = author
+        self.strokes = {}       # stroke_id -> Stroke, insertion order is the z-order
+        self.clock = 0          # Lamport clock, also the sequence number of local strokes
+        self.cleared = (0, "")  # Stamp of the latest clear
+        self.tombstones = {}    # stroke_id -> (stamp, removed, board version)
+        self.version = 0        # Bumped on every change, lets a peer ask for "what changed since"
+        self.cleared_version = 0
+
+    # Lamport clock
+    def tick(self):
+        self.clock += 1
+        return self.clock
+
+    def observe(self, counter):
+        if counter > self.clock:
+            self.clock = counter
+
+    def stamp(self):
+        return self.tick(), self.author
+
+    def touch(self, stroke):
+        self.version += 1
+        stroke.version = self.version
+
+    # Strokes
+    def begin_stroke(self, color, width, x, y):
+        stroke = Stroke((self.author, self.tick()), color, width, (x, y))
+        self.strokes[stroke.stroke_id] = stroke
+        self.touch(stroke)
+        return stroke
+
+    def add_point(self, stroke, x, y):
+        stroke.add_point(x, y)
+        self.touch(stroke)
+
+    def apply_chunk(self, stroke_id, color, width, start, coords):
+        # Points received from another peer are written into the stroke they belong to.
+        # Returns the stroke, or None when it is not visible (cleared or removed)
+        author, seq = stroke_id
+        self.observe(seq)                       # Also keeps restored strokes of ours from reusing ids
+        if (seq, author) < self.cleared:
+            return None                         # Started before a clear we already applied
+        stroke = self.strokes.get(stroke_id)
+        if stroke is None:
+            stroke = self.strokes[stroke_id] = Stroke(stroke_id, color, width)
+        stroke.write(start, coords)
+        self.touch(stroke)
+        return None if self.is_removed(stroke_id) else stroke
+
+    # Clear and tombstones
+    def clear(self, stamp=None):
+        # Local clear when stamp is None. Returns the strokes that survive a remote clear
+        if stamp is None:
+            stamp = self.stamp()
+        else:
+            self.observe(stamp[0])
+        if stamp > self.cleared:
+            self.cleared = stamp
+            for stroke_id in [i for i in self.strokes if (i[1], i[0]) < stamp]:
+                del self.strokes[stroke_id]
+            for stroke_id in [i for i in self.tombstones if (i[1], i[0]) < stamp]:
+                del self.tombstones[stroke_id]     # Nothing left for them to act on
+            self.version += 1
+            self.cleared_version = self.version
+        return list(self)
+
+    def set_removed(self, stroke_id, removed, stamp=None):
+        # Removes (undo, erase) or restores (redo) a stroke. Returns True when the
+        # stroke's visibility changed, False for a stale or repeated operation
+        if stamp is None:
+            stamp = self.stamp()
+        else:
+            self.observe(stamp[0])
+        if (stroke_id[1], stroke_id[0]) < self.cleared:
+            return False
+        current = self.tombstones.get(stroke_id)
+        if current is not None and current[0] >= stamp:
+            return False
+        was_removed = current is not None and current[1]
+        self.version += 1
+        self.tombstones[stroke_id] = (stamp, removed, self.version)
+        return was_removed != removed
+
+    def tombstone(self, stroke_id):
+        # The entry to send for a stroke, as (stroke_id, stamp, removed)
+        stamp, removed, _ = self.tombstones[stroke_id]
+        return stroke_id, stamp, removed
+
+    def is_removed(self, stroke_id):
+        entry = self.tombstones.get(stroke_id)
+        return entry is not None and entry[1]
+
+    def tombstones_since(self, version):
+        return [(stroke_id, stamp, removed) for stroke_id, (stamp, removed, changed) in self.tombstones.items() if changed > version]
+
+    def changed_since(self, version):
+        return [stroke for stroke in self.strokes.values() if stroke.version > version]
+
+    # Visible strokes
+    def __len__(self):
+        return len(self.strokes) - sum(1 for stroke_id, entry in self.tombstones.items() if entry[1] and stroke_id in self.strokes)
+
+    def __iter__(self):
+        if not self.tombstones:
+            return iter(self.strokes.values())
+        return (stroke for stroke_id, stroke in self.strokes.items() if not self.is_removed(stroke_id))
+
+    def segment_count(self):
+        return sum(stroke.segment_count() for stroke in self)
+
+    # Serialization, removed strokes included
+    def to_bytes(self, strokes=None):
+        strokes = self.strokes.values() if strokes is None else strokes
+        return encode_strokes((s.stroke_id, s.color, s.width, 0, s.points) for s in strokes)
+
+    @classmethod
+    def from_bytes(cls, author, data):
+        board = cls(author)
+        board.load(data)
+        return board
+
+    def load(self, data):
+        # Returns the visible strokes that changed
+        return [stroke for stroke in (self.apply_chunk(*chunk) for chunk in decode_strokes(data)) if stroke is not None]
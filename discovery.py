@@ -0,0 +1,199 @@
+import collections
+import math
+import socket
+import threading
+import time
+
+from protocol import ANNOUNCE, QUERY, encode, decode
+
+
+BROADCAST_PORT = 37020          # Rooms announce themselves to this port
+QUERY_PORT = 37021              # Joiners ask rooms on this port to announce right away
+MIN_ANNOUNCE_SECONDS = 0.5      # Announce interval right after start or a change in the room
+MAX_ANNOUNCE_SECONDS = 8        # Interval the announcer backs off to while nothing changes
+TTL_ANNOUNCES = 3               # A room is forgotten after missing this many announcements
+MAX_ROOMS = 256                 # Directory size, the least recently heard rooms go first
+DATAGRAM_SIZE = 2048
+
+
+class Room:
+    __slots__ = ("code", "ip", "port", "peers", "load", "expires")
+
+    def __init__(self, code, ip, port, peers, load, expires):
+        self.code = code
+        self.ip = ip
+        self.port = port
+        self.peers = peers          # People in the room, 0 when unknown
+        self.load = load            # Fullest send queue of the host, percent
+        self.expires = expires
+
+    @property
+    def addr(self):
+        return self.ip, self.port
+
+
+class RoomDirectory:
+    # Rooms heard on the network, each kept until its announced time to live runs
+    # out. Written by the listener thread, read from the Tk thread without blocking.
+
+    def __init__(self, max_rooms=MAX_ROOMS):
+        self.max_rooms = max_rooms
+        self.rooms = collections.OrderedDict()     # code -> Room, least recently heard first
+        self.lock = threading.Lock()
+
+    def update(self, code, ip, port, peers, load, ttl):
+        with self.lock:
+            if ttl <= 0:
+                self.rooms.pop(code, None)          # The room said goodbye
+                return
+            self.rooms[code] = Room(code, ip, port, peers, load, time.monotonic() + ttl)
+            self.rooms.move_to_end(code)
+            while len(self.rooms) > self.max_rooms:
+                self.rooms.popitem(last=False)
+
+    def evict(self):
+        now = time.monotonic()
+        with self.lock:
+            for code in [code for code, room in self.rooms.items() if room.expires <= now]:
+                del self.rooms[code]
+
+    def lookup(self, code):
+        with self.lock:
+            room = self.rooms.get(code)
+        return room if room is not None and room.expires > time.monotonic() else None
+
+    def live(self):
+        self.evict()
+        with self.lock:
+            return sorted(self.rooms.values(), key=lambda room: room.code)
+
+
+def _udp_socket(port=None, broadcast=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if hasattr(socket, "SO_REUSEPORT"):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)      # Several rooms on one machine share the port
+    if broadcast:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    if port is not None:
+        sock.bind(("", port))
+    return sock
+
+
+class DiscoveryListener:
+    # Collects announcements into a RoomDirectory from a background thread. query()
+    # asks every room to answer at once, so a join dialog fills in without waiting
+    # for the next periodic broadcast.
+
+    def __init__(self, directory=None, port=BROADCAST_PORT, query_port=QUERY_PORT):
+        self.directory = directory or RoomDirectory()
+        self.query_port = query_port
+        self.sock = _udp_socket(port, broadcast=True)
+        self.sock.settimeout(1.0)
+        self.running = True
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def query(self):
+        try:
+            self.sock.sendto(encode(QUERY), ("<broadcast>", self.query_port))   # Answers come back to this socket
+        except OSError as e:
+            print(f"Discovery query error: {e}")
+
+    def close(self):
+        self.running = False
+        self.sock.close()
+
+    def _run(self):
+        while self.running:
+            try:
+                data, addr = self.sock.recvfrom(DATAGRAM_SIZE)
+                message_type, payload = decode(data)
+            except socket.timeout:
+                self.directory.evict()
+                continue
+            except OSError:
+                break                               # Socket closed
+            except Exception as e:
+                print(f"Error receiving announcement: {e}")
+                continue
+            if message_type == ANNOUNCE:
+                self.directory.update(*payload)
+
+
+class Announcer:
+    # Broadcasts a room's ANNOUNCE packet. The interval starts at MIN_ANNOUNCE_SECONDS
+    # and doubles up to MAX_ANNOUNCE_SECONDS while the room's status stays the same;
+    # any change (or notify()) makes it announce at once and start fast again. Each
+    # packet carries a time to live covering TTL_ANNOUNCES intervals, and stop()
+    # sends a zero time to live so listeners drop the room immediately.
+
+    def __init__(self, room_code, ip, port, status=None, broadcast_port=BROADCAST_PORT, query_port=QUERY_PORT):
+        self.room_code = room_code
+        self.ip = ip
+        self.port = port
+        self.status = status or (lambda: (0, 0))   # Returns (peer count, load percent)
+        self.broadcast_port = broadcast_port
+        self.sock = _udp_socket(broadcast=True)
+        try:
+            self.query_sock = _udp_socket(query_port)
+            self.query_sock.settimeout(1.0)
+        except OSError as e:
+            print(f"Discovery queries disabled: {e}")
+            self.query_sock = None
+        self.wake = threading.Event()
+        self.running = True
+
+    def start(self):
+        threading.Thread(target=self._announce_loop, daemon=True).start()
+        if self.query_sock:
+            threading.Thread(target=self._query_loop, daemon=True).start()
+        return self
+
+    def notify(self):
+        self.wake.set()
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+        self._send(self.packet(0), ("<broadcast>", self.broadcast_port))
+        if self.query_sock:
+            self.query_sock.close()
+
+    def packet(self, ttl):
+        peers, load = self.status()
+        return encode(ANNOUNCE, (self.room_code, self.ip, self.port, peers, load, ttl))
+
+    def _send(self, data, addr):
+        try:
+            self.sock.sendto(data, addr)
+        except OSError as e:
+            print(f"Broadcast error: {e}")
+
+    def _announce_loop(self):
+        interval = MIN_ANNOUNCE_SECONDS
+        last = None
+        while self.running:
+            status = self.status()
+            if status != last:
+                interval = MIN_ANNOUNCE_SECONDS
+                last = status
+            self._send(self.packet(math.ceil(interval * TTL_ANNOUNCES)), ("<broadcast>", self.broadcast_port))
+            if self.wake.wait(interval):
+                self.wake.clear()
+                interval = MIN_ANNOUNCE_SECONDS
+            else:
+                interval = min(interval * 2, MAX_ANNOUNCE_SECONDS)
+
+    def _query_loop(self):
+        while self.running:
+            try:
+                data, addr = self.query_sock.recvfrom(DATAGRAM_SIZE)
+                message_type, _ = decode(data)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            except Exception:
+                continue                            # Not a discovery datagram
+            if message_type == QUERY:
+                self._send(self.packet(math.ceil(MAX_ANNOUNCE_SECONDS * TTL_ANNOUNCES)), addr)
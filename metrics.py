@@ -0,0 +1,135 @@
+import bisect
+import json
+import time
+
+
+# Histogram bucket upper bounds in seconds, from 50 microseconds to 1 second
+BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+METRIC_PREFIX = "whiteboard_"
+
+
+class Histogram:
+    __slots__ = ("counts", "count", "total", "max")
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)     # Last bucket is +Inf
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def to_dict(self):
+        return {"count": self.count, "sum": self.total, "max": self.max,
+                "p50": self.quantile(0.5), "p99": self.quantile(0.99),
+                "buckets": dict(zip([str(b) for b in BUCKETS] + ["+Inf"], self.counts))}
+
+
+class Timer:
+    # Context manager feeding one histogram, for code paths that may raise
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metrics:
+    # Counters and timing histograms for the hot paths of one Whiteboard (or relay).
+    # Only the thread that owns the object updates it (the Tk thread for the GUI);
+    # network statistics are kept per peer by the engine and merged in snapshot().
+
+    def __init__(self):
+        self.counters = {}
+        self.histograms = {}
+        self.started = time.time()
+
+    def inc(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        return histogram
+
+    def observe(self, name, seconds):
+        self.histogram(name).observe(seconds)
+
+    def timer(self, name):
+        return Timer(self.histogram(name))
+
+    def snapshot(self, peers=None):
+        # peers: {label: NetworkEngine.peer_stats() entry}
+        return {
+            "uptime": time.time() - self.started,
+            "counters": dict(self.counters),
+            "histograms": {name: h.to_dict() for name, h in self.histograms.items()},
+            "peers": peers or {},
+        }
+
+    def to_json(self, peers=None):
+        return json.dumps(self.snapshot(peers), indent=2, sort_keys=True)
+
+    def to_prometheus(self, peers=None):
+        lines = []
+        for name, value in sorted(self.counters.items()):
+            metric = METRIC_PREFIX + _metric_name(name) + "_total"
+            lines += [f"# TYPE {metric} counter", f"{metric} {value}"]
+        for name, h in sorted(self.histograms.items()):
+            metric = METRIC_PREFIX + _metric_name(name) + "_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            seen = 0
+            for bound, count in zip(BUCKETS, h.counts):
+                seen += count
+                lines.append(f'{metric}_bucket{{le="{bound}"}} {seen}')
+            lines.append(f'{metric}_bucket{{le="+Inf"}} {h.count}')
+            lines += [f"{metric}_sum {h.total}", f"{metric}_count {h.count}"]
+        if peers:
+            for field in next(iter(peers.values())):
+                metric = f"{METRIC_PREFIX}peer_{field}"
+                lines.append(f"# TYPE {metric} gauge")
+                lines += [f'{metric}{{peer="{label}"}} {stats[field]}' for label, stats in sorted(peers.items())]
+        return "\n".join(lines) + "\n"
+
+    def dump(self, path, peers=None):
+        # Format follows the extension: .json, anything else is Prometheus text
+        text = self.to_json(peers) if path.endswith(".json") else self.to_prometheus(peers)
+        with open(path, "w") as f:
+            f.write(text)
+
+    def summary(self, peers=None):
+        # Short multi-line text for the overlay panel
+        lines = []
+        for name, h in sorted(self.histograms.items()):
+            if h.count:
+                lines.append(f"{name:<20} {h.count:>7}  avg {h.total / h.count * 1000:6.2f} ms  p99 {h.quantile(0.99) * 1000:6.2f} ms  max {h.max * 1000:6.2f} ms")
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"{name:<20} {value:>7}")
+        for label, stats in sorted((peers or {}).items()):
+            lines.append(f"{label:<22} queue {stats['queue_depth']:>4}  in {stats['bytes_in'] / 1024:8.1f} KB  out {stats['bytes_out'] / 1024:8.1f} KB  decode {stats['decode_ms']:6.1f} ms")
+        return "\n".join(lines)
+
+
+def _metric_name(name):
+    return "".join(c if c.isalnum() else "_" for c in name)
@@ -0,0 +1,265 @@
+import asyncio
+import itertools
+import queue
+import socket
+import threading
+import time
+
+from protocol import FrameDecoder, ProtocolError, StrokeEncoder
+
+
+BUFFER_SIZE = 65536     # Bytes read from a peer socket per call
+OUTBOX_SIZE = 1024      # Frames (or DRAW chunk lists) a peer may have queued before it is treated as too slow
+HEARTBEAT_SECONDS = 2.0 # How often the application pings every peer
+PEER_TIMEOUT = 10.0     # A peer silent (or not taking data) for this long is closed as dead
+WATCHDOG_SECONDS = 1.0  # How often silent peers are looked for
+KEEPALIVE_IDLE = 5      # TCP keepalive: idle seconds before the first probe,
+KEEPALIVE_INTERVAL = 2  # seconds between probes,
+KEEPALIVE_COUNT = 3     # and unanswered probes before the kernel drops the connection
+
+# Events the engine posts to the inbox for the GUI thread
+CONNECTED = "CONNECTED"             # (CONNECTED, peer_id, (ip, port), outgoing)
+MESSAGE = "MESSAGE"                 # (MESSAGE, peer_id, (message_type, payload))
+CLOSED = "CLOSED"                   # (CLOSED, peer_id, reason)
+CONNECT_FAILED = "CONNECT_FAILED"   # (CONNECT_FAILED, None, ((ip, port), error))
+
+
+class Peer:
+    # State for one connection, only touched from the event loop thread
+
+    def __init__(self, peer_id, reader, writer, addr, queue_size):
+        self.peer_id = peer_id
+        self.reader = reader
+        self.writer = writer
+        self.addr = addr
+        self.outbox = asyncio.Queue(maxsize=queue_size)    # Encoded frames, or lists of DRAW chunks
+        self.strokes = StrokeEncoder()                      # DRAW chunks are encoded per connection when written
+        self.tasks = []
+        self.closed = False
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_in = 0
+        self.frames_out = 0
+        self.decode_seconds = 0.0
+        self.last_heard = time.monotonic()
+
+
+class NetworkEngine:
+    # One asyncio event loop in one background thread owns every peer socket.
+    # Other threads talk to it through thread-safe calls (send, broadcast, connect)
+    # and read what happened from self.inbox, so nothing on the GUI side ever blocks
+    # on the network.
+    #
+    # Dead peers are found by three means: TCP keepalive (and TCP_USER_TIMEOUT where
+    # available) for silent half-open sockets, a watchdog closing peers that sent
+    # nothing for peer_timeout seconds (the application pings every HEARTBEAT_SECONDS),
+    # and a peer_timeout limit on every drain of a peer's socket. Either way the
+    # application gets the usual CLOSED event.
+
+    def __init__(self, queue_size=OUTBOX_SIZE, peer_timeout=PEER_TIMEOUT):
+        self.queue_size = queue_size
+        self.peer_timeout = peer_timeout
+        self.inbox = queue.Queue()      # Events for the GUI thread
+        self.loop = asyncio.new_event_loop()
+        self.peers = {}                 # peer_id -> Peer
+        self.server = None
+        self.ids = itertools.count(1)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_later(WATCHDOG_SECONDS, self._watchdog)
+        self.loop.run_forever()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._shutdown(), self.loop).result(timeout=5)
+            self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def _shutdown(self):
+        if self.server:
+            self.server.close()
+        for peer in list(self.peers.values()):
+            self._close(peer, "shutdown")
+        # Peers closed earlier and pending connects too: let everything unwind before the loop stops under it
+        tasks = [task for task in asyncio.all_tasks(self.loop) if task is not asyncio.current_task(self.loop)]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    # Public API, safe to call from any thread
+    def listen(self, ip, port):
+        # Blocks until the listening socket is bound and returns the real (ip, port)
+        return asyncio.run_coroutine_threadsafe(self._listen(ip, port), self.loop).result()
+
+    def connect(self, ip, port, first_frame=None):
+        # Returns a concurrent.futures.Future resolving to the new peer_id. The first
+        # frame (the handshake) is queued before any other traffic for this peer.
+        return asyncio.run_coroutine_threadsafe(self._connect(ip, port, first_frame), self.loop)
+
+    def send(self, peer_id, frame):
+        self.loop.call_soon_threadsafe(self._enqueue, peer_id, frame)
+
+    def broadcast(self, frame, peer_ids=None):
+        # The frame is encoded once by the caller and shared by every peer queue
+        self.loop.call_soon_threadsafe(self._enqueue_many, frame, peer_ids)
+
+    def send_strokes(self, peer_id, chunks):
+        # DRAW chunks, encoded for the connection by its writer (see StrokeEncoder).
+        # The chunks must not be changed after the call.
+        self.loop.call_soon_threadsafe(self._enqueue, peer_id, list(chunks))
+
+    def broadcast_strokes(self, chunks, peer_ids=None):
+        self.loop.call_soon_threadsafe(self._enqueue_many, list(chunks), peer_ids)
+
+    def queue_depths(self):
+        return {peer_id: peer.outbox.qsize() for peer_id, peer in list(self.peers.items())}
+
+    def peer_stats(self):
+        # Traffic counters of every open connection, read without locking (values may be a frame behind)
+        return {peer_id: {"queue_depth": peer.outbox.qsize(), "bytes_in": peer.bytes_in, "bytes_out": peer.bytes_out,
+                          "frames_in": peer.frames_in, "frames_out": peer.frames_out, "decode_ms": peer.decode_seconds * 1000}
+                for peer_id, peer in list(self.peers.items())}
+
+    # Event loop side
+    async def _listen(self, ip, port):
+        self.server = await asyncio.start_server(self._accepted, ip, port, reuse_address=True)
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def _accepted(self, reader, writer):
+        addr = writer.get_extra_info("peername")[:2]
+        self._add_peer(reader, writer, addr, outgoing=False)
+
+    async def _connect(self, ip, port, first_frame):
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port), self.peer_timeout)
+        except asyncio.TimeoutError:
+            error = TimeoutError("connect timed out")
+            self.inbox.put((CONNECT_FAILED, None, ((ip, port), error)))
+            raise error
+        except OSError as e:
+            self.inbox.put((CONNECT_FAILED, None, ((ip, port), e)))
+            raise
+        peer = self._add_peer(reader, writer, (ip, port), outgoing=True, first_frame=first_frame)
+        return peer.peer_id
+
+    def _add_peer(self, reader, writer, addr, outgoing, first_frame=None):
+        _keepalive(writer.get_extra_info("socket"), self.peer_timeout)
+        peer = Peer(next(self.ids), reader, writer, addr, self.queue_size)
+        self.peers[peer.peer_id] = peer
+        if first_frame is not None:
+            peer.outbox.put_nowait(first_frame)
+        self.inbox.put((CONNECTED, peer.peer_id, addr, outgoing))
+        peer.tasks = [
+            self.loop.create_task(self._read_loop(peer)),
+            self.loop.create_task(self._write_loop(peer)),
+        ]
+        return peer
+
+    def _enqueue(self, peer_id, frame):
+        peer = self.peers.get(peer_id)
+        if peer is None or peer.closed:
+            return
+        try:
+            peer.outbox.put_nowait(frame)
+        except asyncio.QueueFull:
+            # Backpressure: a peer that cannot keep up is dropped instead of
+            # growing memory without bound or slowing everybody else down
+            self._close(peer, "send queue full")
+
+    def _enqueue_many(self, frame, peer_ids):
+        for peer_id in list(self.peers if peer_ids is None else peer_ids):
+            self._enqueue(peer_id, frame)
+
+    async def _read_loop(self, peer):
+        decoder = FrameDecoder()
+        reason = "connection closed"
+        try:
+            while True:
+                data = await peer.reader.read(BUFFER_SIZE)
+                if not data:
+                    break
+                started = time.perf_counter()
+                messages = decoder.feed(data)
+                peer.decode_seconds += time.perf_counter() - started
+                peer.bytes_in += len(data)
+                peer.last_heard = time.monotonic()
+                peer.frames_in += len(messages)
+                for message in messages:
+                    self.inbox.put((MESSAGE, peer.peer_id, message))
+        except (OSError, ProtocolError) as e:
+            reason = str(e)
+        except asyncio.CancelledError:
+            return
+        self._close(peer, reason)
+
+    async def _write_loop(self, peer):
+        try:
+            while True:
+                items = [await peer.outbox.get()]
+                while not peer.outbox.empty():
+                    items.append(peer.outbox.get_nowait())     # Coalesce whatever else is waiting into one write
+                frames = self._encode(peer, items)
+                peer.writer.writelines(frames)
+                peer.frames_out += len(frames)
+                peer.bytes_out += sum(map(len, frames))
+                await asyncio.wait_for(peer.writer.drain(), self.peer_timeout)     # Waits only this peer's task when its socket is full
+        except asyncio.TimeoutError:
+            self._close(peer, "send timed out")
+        except (OSError, ProtocolError) as e:
+            self._close(peer, str(e))
+        except asyncio.CancelledError:
+            pass
+
+    def _encode(self, peer, items):
+        # DRAW chunk lists queued back to back become one STROKES frame, other frames keep their place
+        frames = []
+        chunks = []
+        for item in items:
+            if isinstance(item, list):
+                chunks.extend(item)
+                continue
+            if chunks:
+                frames.append(peer.strokes.encode(chunks))
+                chunks = []
+            frames.append(item)
+        if chunks:
+            frames.append(peer.strokes.encode(chunks))
+        return frames
+
+    def _watchdog(self):
+        deadline = time.monotonic() - self.peer_timeout
+        for peer in list(self.peers.values()):
+            if peer.last_heard < deadline:
+                self._close(peer, "timed out")
+        self.loop.call_later(WATCHDOG_SECONDS, self._watchdog)
+
+    def _close(self, peer, reason):
+        if peer.closed:
+            return
+        peer.closed = True
+        self.peers.pop(peer.peer_id, None)
+        current = asyncio.current_task(self.loop)
+        for task in peer.tasks:
+            if task is not current:
+                task.cancel()
+        peer.writer.close()
+        self.inbox.put((CLOSED, peer.peer_id, reason))
+
+
+def _keepalive(sock, timeout):
+    # Lets the kernel notice dead connections that the heartbeats are not reaching
+    if sock is None:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL),
+                              ("TCP_KEEPCNT", KEEPALIVE_COUNT), ("TCP_USER_TIMEOUT", int(timeout * 1000))):
+            if hasattr(socket, option):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+    except OSError as e:
+        print(f"Could not enable keepalive: {e}")
@@ -0,0 +1,125 @@
+import concurrent.futures
+import multiprocessing
+import os
+import queue
+import time
+from concurrent.futures.process import BrokenProcessPool
+
+
+POLL_MS = 15                # How often the Tk loop picks up finished jobs
+
+
+def default_workers():
+    # Leave one core to the Tk and network threads
+    return max((os.cpu_count() or 2) - 1, 1)
+
+
+class Offloader:
+    # Runs CPU-heavy jobs (smoothing, snapshot compression, exports) in a process pool
+    # so they neither block the Tk thread nor compete with it for the GIL. Results are
+    # handed back through a queue that the Tk loop drains from an after() tick, so
+    # callbacks always run on the Tk thread and may touch widgets.
+    #
+    # Jobs must be module-level functions with picklable arguments. The pool uses the
+    # spawn start method: forking a process that already runs the network and Tk
+    # threads is unsafe. With workers=0, or if the pool cannot start or breaks, jobs
+    # run inline and callbacks still go through the queue.
+
+    def __init__(self, workers=None, metrics=None):
+        self.workers = default_workers() if workers is None else workers
+        self.metrics = metrics
+        self.pool = None
+        self.results = queue.Queue()            # (callback, error, result, exception, job name, start time)
+        self.after_id = None
+
+    def start(self, master):
+        self.master = master
+        self.after_id = master.after(POLL_MS, self.poll)
+        return self
+
+    def shutdown(self):
+        if self.after_id is not None:
+            self.master.after_cancel(self.after_id)
+            self.after_id = None
+        if self.pool is not None:
+            self.pool.shutdown(wait=False, cancel_futures=True)
+            self.pool = None
+
+    def _get_pool(self):
+        if self.pool is None and self.workers > 0:
+            try:
+                self.pool = concurrent.futures.ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            except (OSError, ValueError, NotImplementedError) as e:
+                print(f"Process pool unavailable, running jobs inline: {e}")
+                self.workers = 0
+        return self.pool
+
+    def submit(self, fn, *args, callback=None, error=None, **kwargs):
+        # callback(result) or error(exception) is called later on the Tk thread
+        started = time.perf_counter()
+        pool = self._get_pool()
+        if pool is not None:
+            try:
+                future = pool.submit(fn, *args, **kwargs)
+            except (BrokenProcessPool, RuntimeError) as e:
+                print(f"Process pool failed, running jobs inline: {e}")
+                self.pool, self.workers = None, 0
+            else:
+                future.add_done_callback(lambda f: self._finished(f, callback, error, fn.__name__, started))
+                return
+        try:
+            self.results.put((callback, error, fn(*args, **kwargs), None, fn.__name__, started))
+        except Exception as e:
+            self.results.put((callback, error, None, e, fn.__name__, started))
+
+    def _finished(self, future, callback, error, name, started):
+        # Runs in the pool's management thread, only queues the outcome
+        if future.cancelled():
+            return
+        exception = future.exception()
+        self.results.put((callback, error, None if exception else future.result(), exception, name, started))
+
+    def map(self, fn, items, callback, error=None):
+        # Runs fn on every item in parallel, callback gets the results in item order
+        items = list(items)
+        results = [None] * len(items)
+        left = [len(items)]
+        failed = []
+        if not items:
+            self.results.put((callback, None, results, None, fn.__name__, time.perf_counter()))
+            return
+
+        def done(i, result):
+            results[i] = result
+            left[0] -= 1
+            if not left[0] and not failed:
+                callback(results)
+
+        def fail(e):
+            if not failed:
+                failed.append(e)
+                (error or _report)(e)
+
+        for i, item in enumerate(items):
+            self.submit(fn, item, callback=lambda result, i=i: done(i, result), error=fail)
+
+    def poll(self):
+        try:
+            while True:
+                callback, error, result, exception, name, started = self.results.get_nowait()
+                if self.metrics is not None:
+                    self.metrics.observe(f"offload_{name}", time.perf_counter() - started)
+                try:
+                    if exception is not None:
+                        (error or _report)(exception)
+                    elif callback is not None:
+                        callback(result)
+                except Exception as e:
+                    print(f"Offload callback error: {e}")
+        except queue.Empty:
+            pass
+        self.after_id = self.master.after(POLL_MS, self.poll)
+
+
+def _report(exception):
+    print(f"Offloaded job failed: {exception}")
@@ -0,0 +1,541 @@
+import struct
+import zlib
+from array import array
+from itertools import accumulate
+import sys
+
+
+# Message types (kept as strings so the GUI code can compare them directly)
+HELLO = "HELLO"  # Handshake: name, ip and listening port of the connecting peer
+DRAW = "DRAW"    # Message type for drawing actions
+CLEAR = "CLEAR"  # Message type for clearing the canvas, carries the Lamport stamp of the clear
+PEER = "PEER"    # Message type for peer information
+MAP = "MAP"      # Message type for broadcasting room maps
+SNAPSHOT = "SNAPSHOT"   # Compressed group of whole strokes sent to a peer that joined late
+SYNC_END = "SYNC_END"   # Last snapshot frame, carries the board version the snapshot was taken at
+SYNC_ACK = "SYNC_ACK"   # Joiner applied the snapshot, asks for whatever changed since that version
+ANNOUNCE = "ANNOUNCE"   # Room advertisement datagram: code, address, peer count, load and time to live
+QUERY = "QUERY"         # Datagram asking every room on the network to announce itself now
+TOMBSTONE = "TOMBSTONE" # Removes or restores whole strokes (undo, redo, erase), last writer wins
+STROKES = "STROKES"     # DRAW chunks encoded against what was already sent on the connection, decoded as DRAW
+PING = "PING"           # Heartbeat, carries the sender's board version: everything before it on the connection is in it
+GONE = "GONE"           # Names (and addresses) of peers whose connection died, to prune from peer maps
+
+TYPE_CODES = {HELLO: 1, DRAW: 2, CLEAR: 3, PEER: 4, MAP: 5, SNAPSHOT: 6, SYNC_END: 7, SYNC_ACK: 8, ANNOUNCE: 9, QUERY: 10, TOMBSTONE: 11, STROKES: 12,
+              PING: 13, GONE: 14}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+HEADER = struct.Struct("!IB")   # Frame header: body length (u32) and message type (u8)
+MAX_FRAME = 16 * 1024 * 1024    # Refuse frames bigger than this, the stream is corrupt
+COORD_MIN, COORD_MAX = -32768, 32767
+
+COMPRESSED = 0x80               # Set on the type byte when the body is zlib compressed
+COMPRESSIBLE = {DRAW, PEER, MAP, TOMBSTONE, STROKES, GONE}   # SNAPSHOT bodies are compressed already
+COMPRESS_MIN_BYTES = 1024       # Smaller bodies are sent as they are
+COMPRESS_LEVEL = 1
+
+STROKE_SLOTS = 256              # Strokes a STROKES stream remembers, referred to by a one byte slot
+MAX_STRINGS = 4096              # Authors and colors a STROKES stream interns, later ones are sent inline
+
+_U8 = struct.Struct("!B")
+_U16 = struct.Struct("!H")
+_U32 = struct.Struct("!I")
+_ROOM_STATUS = struct.Struct("!HHBH")   # port, peer count, load percent, ttl seconds
+_BIG_ENDIAN = sys.byteorder == "big"
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+# Low level field helpers
+def _pack_str(value):
+    raw = value.encode("utf-8")
+    if len(raw) > 255:
+        raise ProtocolError(f"String too long for frame: {value[:20]}...")
+    return _U8.pack(len(raw)) + raw
+
+
+def _unpack_str(body, offset):
+    length = body[offset]
+    offset += 1
+    return bytes(body[offset:offset + length]).decode("utf-8"), offset + length
+
+
+def _pack_varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def _unpack_varint(body, offset):
+    value = shift = 0
+    while True:
+        byte = body[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+        if shift > 63:
+            raise ProtocolError("Varint too long")
+
+
+def _clamp(value):
+    value = int(value)
+    if value < COORD_MIN:
+        return COORD_MIN
+    if value > COORD_MAX:
+        return COORD_MAX
+    return value
+
+
+def _pack_coords(coords):
+    try:
+        packed = array("h", coords)
+    except (OverflowError, TypeError):
+        packed = array("h", (_clamp(c) for c in coords))   # Off-canvas or float coordinates
+    if not _BIG_ENDIAN:
+        packed.byteswap()   # Coordinates go on the wire in network byte order
+    return packed.tobytes()
+
+
+def _check_length(body, end):
+    # Counts in a frame are checked against its size before anything is allocated for them
+    if end > len(body):
+        raise ProtocolError(f"Frame body too short: {end} bytes needed, {len(body)} received")
+
+
+def _unpack_coords(body, offset, count):
+    coords = array("h")
+    end = offset + count * 2
+    _check_length(body, end)
+    coords.frombytes(body[offset:end])
+    if not _BIG_ENDIAN:
+        coords.byteswap()
+    return coords, end
+
+
+# Point formats: the first point is absolute, the rest are deltas to the previous point.
+# Mouse strokes move a few pixels per event, so deltas nearly always fit in one byte
+POINTS_DELTA8 = 0
+POINTS_DELTA16 = 1
+POINTS_DELTA32 = 2      # Only in STROKES frames, for jumps between far off-canvas points
+
+# STROKES chunk flags
+CHUNK_NEW = 1           # First chunk of the stroke on this connection: author, seq, color and width follow
+CHUNK_CONTINUE = 2      # Starts where the stroke's last chunk ended, points are relative to its last point
+
+
+def _pack_points(coords):
+    if len(coords) < 4:
+        return _U8.pack(POINTS_DELTA16) + _pack_coords(coords)
+    deltas = [b - a for a, b in zip(coords, coords[2:])]
+    try:
+        return _U8.pack(POINTS_DELTA8) + _pack_coords(coords[:2]) + array("b", deltas).tobytes()
+    except OverflowError:
+        return _U8.pack(POINTS_DELTA16) + _pack_coords(coords[:2]) + _pack_coords(deltas)
+
+
+def _unpack_points(body, offset, point_count):
+    point_format = body[offset]
+    first, offset = _unpack_coords(body, offset + 1, min(point_count, 1) * 2)
+    if point_count < 2:
+        return first, offset
+    if point_format == POINTS_DELTA8:
+        deltas = array("b")
+        end = offset + (point_count - 1) * 2
+        _check_length(body, end)
+        deltas.frombytes(body[offset:end])
+    else:
+        deltas, end = _unpack_coords(body, offset, (point_count - 1) * 2)
+    coords = array("h", bytes(point_count * 4))
+    coords[0::2] = array("h", accumulate(deltas[0::2], initial=first[0]))
+    coords[1::2] = array("h", accumulate(deltas[1::2], initial=first[1]))
+    return coords, end
+
+
+def _pack_deltas(deltas):
+    for point_format, typecode in ((POINTS_DELTA8, "b"), (POINTS_DELTA16, "h"), (POINTS_DELTA32, "i")):
+        try:
+            packed = array(typecode, deltas)
+        except OverflowError:
+            continue
+        if not _BIG_ENDIAN:
+            packed.byteswap()
+        return _U8.pack(point_format) + packed.tobytes()
+
+
+def _unpack_deltas(body, offset, count):
+    typecode = {POINTS_DELTA8: "b", POINTS_DELTA16: "h", POINTS_DELTA32: "i"}.get(body[offset])
+    if typecode is None:
+        raise ProtocolError(f"Unknown point format: {body[offset]}")
+    deltas = array(typecode)
+    end = offset + 1 + count * deltas.itemsize
+    _check_length(body, end)
+    deltas.frombytes(body[offset + 1:end])
+    if not _BIG_ENDIAN:
+        deltas.byteswap()
+    return deltas, end
+
+
+def _pack_addr_map(addr_map):
+    parts = [_U16.pack(len(addr_map))]
+    for name, (ip, port) in addr_map.items():
+        parts.append(_pack_str(name))
+        parts.append(_pack_str(ip))
+        parts.append(_U16.pack(int(port)))
+    return b"".join(parts)
+
+
+def _unpack_addr_map(body):
+    (count,) = _U16.unpack_from(body, 0)
+    offset = 2
+    addr_map = {}
+    for _ in range(count):
+        name, offset = _unpack_str(body, offset)
+        ip, offset = _unpack_str(body, offset)
+        (port,) = _U16.unpack_from(body, offset)
+        offset += 2
+        addr_map[name] = (ip, port)
+    return addr_map
+
+
+# Body encoders
+def encode_strokes(chunks):
+    # DRAW body and board serialization: each chunk is (stroke_id, color, width, start, coords)
+    # where coords are flat x, y points written into the stroke from point index start
+    parts = []
+    count = 0
+    for (author, seq), color, width, start, coords in chunks:
+        parts.append(_pack_str(author))
+        parts.append(_U32.pack(seq))
+        parts.append(_pack_str(color))
+        parts.append(_U8.pack(int(width)))
+        parts.append(_U32.pack(start))
+        parts.append(_U32.pack(len(coords) // 2))
+        parts.append(_pack_points(coords))
+        count += 1
+    return _U32.pack(count) + b"".join(parts)
+
+
+def decode_strokes(body):
+    (count,) = _U32.unpack_from(body, 0)
+    offset = 4
+    chunks = []
+    for _ in range(count):
+        author, offset = _unpack_str(body, offset)
+        (seq,) = _U32.unpack_from(body, offset)
+        color, offset = _unpack_str(body, offset + 4)
+        width = body[offset]
+        start, point_count = _U32.unpack_from(body, offset + 1)[0], _U32.unpack_from(body, offset + 5)[0]
+        coords, offset = _unpack_points(body, offset + 9, point_count)
+        chunks.append(((author, seq), color, width, start, coords))
+    return chunks
+
+
+def _encode_hello(payload):
+    # sync is set by a peer joining a room, it asks the other side for a board snapshot
+    name, ip, port, sync = payload
+    return _pack_str(name) + _pack_str(ip) + _U16.pack(int(port)) + _U8.pack(bool(sync))
+
+
+def _decode_hello(body):
+    name, offset = _unpack_str(body, 0)
+    ip, offset = _unpack_str(body, offset)
+    (port,) = _U16.unpack_from(body, offset)
+    return name, ip, port, bool(body[offset + 2])
+
+
+def _encode_announce(payload):
+    room_code, ip, port, peers, load, ttl = payload
+    return _pack_str(room_code) + _pack_str(ip) + _ROOM_STATUS.pack(int(port), min(int(peers), 0xFFFF), min(max(int(load), 0), 100), min(int(ttl), 0xFFFF))
+
+
+def _decode_announce(body):
+    room_code, offset = _unpack_str(body, 0)
+    ip, offset = _unpack_str(body, offset)
+    return (room_code, ip) + _ROOM_STATUS.unpack_from(body, offset)
+
+
+def _pack_stamp(stamp):
+    # Lamport stamp: (counter, site), compared as a tuple
+    counter, site = stamp
+    return _U32.pack(counter) + _pack_str(site)
+
+
+def _unpack_stamp(body, offset=0):
+    (counter,) = _U32.unpack_from(body, offset)
+    site, offset = _unpack_str(body, offset + 4)
+    return (counter, site), offset
+
+
+def _encode_tombstones(entries):
+    # Each entry is (stroke_id, stamp, removed)
+    parts = [_U32.pack(len(entries))]
+    for (author, seq), stamp, removed in entries:
+        parts.append(_pack_str(author) + _U32.pack(seq) + _pack_stamp(stamp) + _U8.pack(bool(removed)))
+    return b"".join(parts)
+
+
+def _decode_tombstones(body):
+    (count,) = _U32.unpack_from(body, 0)
+    offset = 4
+    entries = []
+    for _ in range(count):
+        author, offset = _unpack_str(body, offset)
+        (seq,) = _U32.unpack_from(body, offset)
+        stamp, offset = _unpack_stamp(body, offset + 4)
+        entries.append(((author, seq), stamp, bool(body[offset])))
+        offset += 1
+    return entries
+
+
+ENCODERS = {
+    HELLO: _encode_hello,
+    DRAW: encode_strokes,
+    CLEAR: _pack_stamp,
+    PEER: _pack_addr_map,
+    MAP: _pack_addr_map,
+    SNAPSHOT: bytes,
+    SYNC_END: _U32.pack,
+    SYNC_ACK: _U32.pack,
+    ANNOUNCE: _encode_announce,
+    QUERY: lambda payload: b"",
+    TOMBSTONE: _encode_tombstones,
+    PING: _U32.pack,
+    GONE: _pack_addr_map,
+}
+
+DECODERS = {
+    HELLO: _decode_hello,
+    DRAW: decode_strokes,
+    CLEAR: lambda body: _unpack_stamp(body)[0],
+    PEER: _unpack_addr_map,
+    MAP: _unpack_addr_map,
+    SNAPSHOT: bytes,
+    SYNC_END: lambda body: _U32.unpack(body)[0],
+    SYNC_ACK: lambda body: _U32.unpack(body)[0],
+    ANNOUNCE: _decode_announce,
+    QUERY: lambda body: None,
+    TOMBSTONE: _decode_tombstones,
+    PING: lambda body: _U32.unpack(body)[0],
+    GONE: _unpack_addr_map,
+}
+
+
+def encode(message_type, payload=None):
+    # Build one complete frame (header + body) ready to be written to a socket
+    return _frame(message_type, ENCODERS[message_type](payload))
+
+
+def _frame(message_type, body):
+    if len(body) > MAX_FRAME:
+        raise ProtocolError(f"Frame too large: {len(body)} bytes")
+    code = TYPE_CODES[message_type]
+    if message_type in COMPRESSIBLE and len(body) >= COMPRESS_MIN_BYTES:
+        packed = zlib.compress(body, COMPRESS_LEVEL)
+        if len(packed) < len(body):
+            body, code = packed, code | COMPRESSED
+    return HEADER.pack(len(body), code) + body
+
+
+def unpack_body(code, body):
+    # Message type and plain body of a frame, inflating compressed bodies
+    message_type = TYPE_NAMES.get(code & ~COMPRESSED)
+    if message_type is None:
+        raise ProtocolError(f"Unknown message type: {code}")
+    if code & COMPRESSED:
+        inflater = zlib.decompressobj()
+        try:
+            body = inflater.decompress(body, MAX_FRAME)
+        except zlib.error as e:
+            raise ProtocolError(f"Corrupt compressed frame: {e}")
+        if inflater.unconsumed_tail:
+            raise ProtocolError("Compressed frame too large")
+    return message_type, body
+
+
+def decode(frame):
+    # Decode a single complete frame, used for datagrams where there is no stream
+    messages = FrameDecoder().feed(frame)
+    if len(messages) != 1:
+        raise ProtocolError("Expected exactly one frame")
+    return messages[0]
+
+
+class StrokeEncoder:
+    # Send side of the STROKES stream of one connection. Authors and colors are sent
+    # once and then referred to by index; a stroke's id, color and width only go with
+    # its first chunk, later chunks name the stroke by a one byte slot; and a chunk
+    # that carries on where the stroke's previous chunk ended leaves out its start and
+    # writes every point relative to the last one sent. The StrokeDecoder on the other
+    # end rebuilds the same tables from the frames in the order they were written.
+
+    def __init__(self):
+        self.strings = {}                       # Interned string -> index
+        self.slots = {}                         # stroke_id -> slot
+        self.ids = [None] * STROKE_SLOTS        # slot -> stroke_id
+        self.styles = [None] * STROKE_SLOTS     # slot -> (color, width)
+        self.ends = [None] * STROKE_SLOTS       # slot -> (next point index, last x, last y)
+        self.next_slot = 0
+
+    def _ref(self, value):
+        index = self.strings.get(value)
+        if index is not None:
+            return _pack_varint(index + 1)
+        if len(self.strings) < MAX_STRINGS:
+            self.strings[value] = len(self.strings)
+        return b"\x00" + _pack_str(value)
+
+    def _assign(self, stroke_id, style):
+        slot = self.next_slot
+        self.next_slot = (slot + 1) % STROKE_SLOTS
+        old = self.ids[slot]
+        if old is not None and self.slots.get(old) == slot:
+            del self.slots[old]
+        self.ids[slot] = stroke_id
+        self.styles[slot] = style
+        self.ends[slot] = None
+        self.slots[stroke_id] = slot
+        return slot
+
+    def encode(self, chunks):
+        # One STROKES frame for a list of DRAW chunks
+        parts = [_pack_varint(len(chunks))]
+        for stroke_id, color, width, start, coords in chunks:
+            try:
+                points = array("h", coords)
+            except (OverflowError, TypeError):
+                points = array("h", (_clamp(c) for c in coords))
+            style = (color, int(width))
+            slot = self.slots.get(stroke_id)
+            if slot is None or self.styles[slot] != style:
+                slot = self._assign(stroke_id, style)
+                flags = CHUNK_NEW
+                head = self._ref(stroke_id[0]) + _pack_varint(stroke_id[1]) + self._ref(color) + _U8.pack(style[1])
+            else:
+                flags = 0
+                head = _U8.pack(slot)
+            end = self.ends[slot]
+            if end is not None and end[0] == start:
+                flags |= CHUNK_CONTINUE
+                base, rest = end[1:], points
+            else:
+                head += _pack_varint(start)
+                base, rest = points[:2], points[2:]
+            count = len(points) // 2
+            parts.append(_U8.pack(flags) + head + _pack_varint(count))
+            if count:
+                if not flags & CHUNK_CONTINUE:
+                    parts.append(_pack_coords(base))
+                parts.append(_pack_deltas([b - a for a, b in zip(list(base) + list(rest), rest)]))
+                self.ends[slot] = (start + count, points[-2], points[-1])
+        return _frame(STROKES, b"".join(parts))
+
+
+class StrokeDecoder:
+    # Receive side of a STROKES stream, see StrokeEncoder
+
+    def __init__(self):
+        self.strings = []
+        self.strokes = [None] * STROKE_SLOTS    # slot -> (stroke_id, color, width)
+        self.ends = [None] * STROKE_SLOTS
+        self.next_slot = 0
+
+    def _ref(self, body, offset):
+        index, offset = _unpack_varint(body, offset)
+        if index:
+            if index > len(self.strings):
+                raise ProtocolError(f"Unknown string reference: {index}")
+            return self.strings[index - 1], offset
+        value, offset = _unpack_str(body, offset)
+        if len(self.strings) < MAX_STRINGS:
+            self.strings.append(value)
+        return value, offset
+
+    def decode(self, body):
+        count, offset = _unpack_varint(body, 0)
+        chunks = []
+        for _ in range(count):
+            flags = body[offset]
+            if flags & CHUNK_NEW:
+                author, offset = self._ref(body, offset + 1)
+                seq, offset = _unpack_varint(body, offset)
+                color, offset = self._ref(body, offset)
+                slot = self.next_slot
+                self.next_slot = (slot + 1) % STROKE_SLOTS
+                self.strokes[slot] = ((author, seq), color, body[offset])
+                self.ends[slot] = None
+                offset += 1
+            else:
+                slot = body[offset + 1]
+                offset += 2
+                if self.strokes[slot] is None:
+                    raise ProtocolError(f"Unknown stroke slot: {slot}")
+            stroke_id, color, width = self.strokes[slot]
+            continued = flags & CHUNK_CONTINUE
+            if continued:
+                if self.ends[slot] is None:
+                    raise ProtocolError(f"Nothing to continue in slot {slot}")
+                start, x, y = self.ends[slot]
+            else:
+                start, offset = _unpack_varint(body, offset)
+            point_count, offset = _unpack_varint(body, offset)
+            if not point_count:
+                chunks.append((stroke_id, color, width, start, array("h")))
+                continue
+            if not continued:
+                (x, y), offset = _unpack_coords(body, offset, 2)
+            deltas, offset = _unpack_deltas(body, offset, (point_count - (0 if continued else 1)) * 2)
+            skip = 1 if continued else 0                # A continued chunk does not repeat its base point
+            coords = array("h", bytes(point_count * 4))
+            coords[0::2] = array("h", list(accumulate(deltas[0::2], initial=x))[skip:])
+            coords[1::2] = array("h", list(accumulate(deltas[1::2], initial=y))[skip:])
+            self.ends[slot] = (start + point_count, coords[-2], coords[-1])
+            chunks.append((stroke_id, color, width, start, coords))
+        return chunks
+
+
+class FrameDecoder:
+    # Streaming decoder: feed it whatever recv() returned and it hands back every
+    # complete message, keeping partial frames until the rest arrives. STROKES
+    # frames come out as DRAW messages.
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.strokes = StrokeDecoder()
+
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            length, code = HEADER.unpack_from(self.buffer, offset)
+            if length > MAX_FRAME:
+                raise ProtocolError(f"Frame too large: {length} bytes")
+            if code & ~COMPRESSED not in TYPE_NAMES:
+                raise ProtocolError(f"Unknown message type: {code}")
+            end = offset + HEADER.size + length
+            if end > len(self.buffer):
+                break                                               # Wait for the rest of the frame
+            message_type, body = unpack_body(code, bytes(self.buffer[offset + HEADER.size:end]))
+            try:
+                if message_type == STROKES:
+                    messages.append((DRAW, self.strokes.decode(body)))
+                else:
+                    messages.append((message_type, DECODERS[message_type](body)))
+            except ProtocolError:
+                raise
+            except (struct.error, IndexError, ValueError, OverflowError) as e:
+                # Short body, bad UTF-8 or points out of range: the peer sent garbage
+                raise ProtocolError(f"Malformed {message_type} frame: {e}")
+            offset = end
+        del self.buffer[:offset]
+        return messages
+
+    def pending(self):
+        return len(self.buffer)
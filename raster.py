@@ -0,0 +1,69 @@
+import math
+import struct
+import zlib
+
+
+# Small pure-Python rasterizer: enough to flatten strokes into images without Tk
+# (tile cache, headless export). Lines are drawn by stamping filled discs along each
+# segment, one horizontal span per disc row.
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def _disc_spans(radius):
+    r = max(int(math.ceil(radius - 0.5)), 0)
+    return [(dy, int(math.sqrt(max(radius * radius - dy * dy, 0)))) for dy in range(-r, r + 1)]
+
+
+def _png_chunk(kind, data):
+    chunk = kind + data
+    return struct.pack("!I", len(data)) + chunk + struct.pack("!I", zlib.crc32(chunk) & 0xFFFFFFFF)
+
+
+class Raster:
+    # RGBA pixel buffer. Without a background the image is transparent where nothing was drawn
+
+    def __init__(self, width, height, background=None):
+        self.width = width
+        self.height = height
+        fill = bytes(background) + b"\xff" if background else b"\x00\x00\x00\x00"
+        self.pixels = bytearray(fill * (width * height))
+
+    def draw_stroke(self, points, rgb, width, origin_x=0.0, origin_y=0.0, scale=1.0):
+        # points are flat world coordinates, pixel = (world - origin) * scale
+        radius = max(width * scale / 2, 0.5)
+        spans = _disc_spans(radius)
+        color = bytes(rgb) + b"\xff"
+        spacing = max(radius / 2, 1.0)
+        stamp = self._stamp
+        prev = None
+        for i in range(0, len(points) - 1, 2):
+            x = (points[i] - origin_x) * scale
+            y = (points[i + 1] - origin_y) * scale
+            if prev is None:
+                stamp(x, y, spans, color)
+            else:
+                px, py = prev
+                steps = max(int(math.hypot(x - px, y - py) / spacing), 1)
+                for step in range(1, steps + 1):
+                    t = step / steps
+                    stamp(px + (x - px) * t, py + (y - py) * t, spans, color)
+            prev = (x, y)
+
+    def _stamp(self, cx, cy, spans, color):
+        width, height, pixels = self.width, self.height, self.pixels
+        cx, cy = int(round(cx)), int(round(cy))
+        for dy, half in spans:
+            row = cy + dy
+            if row < 0 or row >= height:
+                continue
+            x0, x1 = max(cx - half, 0), min(cx + half, width - 1)
+            if x0 <= x1:
+                offset = (row * width + x0) * 4
+                pixels[offset:offset + (x1 - x0 + 1) * 4] = color * (x1 - x0 + 1)
+
+    def to_png(self, level=6):
+        stride = self.width * 4
+        rows = b"".join(b"\x00" + bytes(self.pixels[y * stride:(y + 1) * stride]) for y in range(self.height))
+        header = struct.pack("!IIBBBBB", self.width, self.height, 8, 6, 0, 0, 0)     # 8-bit RGBA
+        return PNG_SIGNATURE + _png_chunk(b"IHDR", header) + _png_chunk(b"IDAT", zlib.compress(rows, level)) + _png_chunk(b"IEND", b"")
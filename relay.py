@@ -0,0 +1,219 @@
+import argparse
+import queue
+import random
+import socket
+import string
+import time
+
+from board import Board
+from discovery import Announcer
+from metrics import Metrics
+from network import NetworkEngine, CONNECTED, MESSAGE, CLOSED, OUTBOX_SIZE, HEARTBEAT_SECONDS
+from protocol import HELLO, DRAW, CLEAR, PEER, SNAPSHOT, SYNC_ACK, TOMBSTONE, PING, GONE, encode
+from session_log import SessionLog
+from sync import sync_frames, catch_up_frames, apply_snapshot
+
+
+MAX_EVENTS_PER_PASS = 500   # Events handled before the pending output is flushed
+METRICS_SECONDS = 5         # Interval between metrics dumps with --metrics
+
+
+class Relay:
+    # Headless hub for large rooms. Clients join with the usual room code and HELLO,
+    # but instead of meshing every client holds a single connection to the relay.
+    # The relay keeps its own copy of the board to sync late joiners, and fans each
+    # update out to every other client as one frame encoded once and shared by every
+    # outgoing queue. DRAW chunks that arrive together are merged per sender and
+    # queued as they are: the network engine encodes them per client against what
+    # that connection already carried, and coalesces each client's queue into one write.
+    #
+    # The roster sent to clients maps every name to the relay's own address, so a
+    # client lists the other participants but never dials them: it is already
+    # connected to that address. When a client's connection dies the others get a
+    # GONE for its name; a client that comes back resumes from its last ping.
+
+    def __init__(self, ip, port=0, room_code=None, session_file=None, metrics_file=None):
+        self.net = NetworkEngine().start()
+        self.ip, self.port = self.net.listen(ip, port)
+        self.room_code = room_code
+        self.board = Board("relay")
+        self.clients = {}                   # peer_id -> name, once the client said HELLO
+        self.told = {}                      # peer_id -> names already in the roster that client was sent
+        self.addrs = {}                     # peer_id -> listening address the client gave in its HELLO
+        self.marks = {}                     # Client address -> board version of its last ping
+        self.next_ping = time.monotonic() + HEARTBEAT_SECONDS
+        self.pending = {}                   # peer_id -> DRAW chunks received but not yet forwarded
+        self.session_log = SessionLog(session_file, self.board) if session_file else None
+        self.metrics = Metrics()
+        self.metrics_file = metrics_file
+        self.next_dump = time.monotonic() + METRICS_SECONDS
+        self.announcer = None
+        self.running = True
+
+    def room_status(self):
+        depths = self.net.queue_depths()
+        return len(self.clients), max(depths.values(), default=0) * 100 // OUTBOX_SIZE
+
+    def serve_forever(self):
+        if self.room_code:
+            self.announcer = Announcer(self.room_code, self.ip, self.port, self.room_status).start()    # Advertised like a hosting whiteboard
+        print(f"Relay for room {self.room_code} listening at {self.ip}:{self.port}")
+        try:
+            while self.running:
+                self.run_pass()
+                if time.monotonic() >= self.next_ping:
+                    self.next_ping = time.monotonic() + HEARTBEAT_SECONDS
+                    self.heartbeat()
+                if self.metrics_file and time.monotonic() >= self.next_dump:
+                    self.next_dump = time.monotonic() + METRICS_SECONDS
+                    self.dump_metrics()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        self.running = False
+        if self.announcer:
+            self.announcer.stop()
+        if self.session_log:
+            self.session_log.close()
+        if self.metrics_file:
+            self.dump_metrics()
+        self.net.stop()
+
+    def dump_metrics(self):
+        peers = {f"{self.clients.get(peer_id, 'peer')}#{peer_id}": stats for peer_id, stats in self.net.peer_stats().items()}
+        self.metrics.dump(self.metrics_file, peers)
+
+    def heartbeat(self):
+        self.flush()                        # The ping must follow every change it covers
+        self.net.broadcast(encode(PING, self.board.version), list(self.clients))
+
+    def run_pass(self, timeout=0.5):
+        # Wait for one event, then take whatever else is already queued
+        try:
+            event = self.net.inbox.get(timeout=timeout)
+        except queue.Empty:
+            return
+        started = time.perf_counter()
+        for _ in range(MAX_EVENTS_PER_PASS):
+            self.handle_event(*event)
+            try:
+                event = self.net.inbox.get_nowait()
+            except queue.Empty:
+                break
+        self.flush()
+        self.metrics.observe("relay_pass", time.perf_counter() - started)
+
+    def handle_event(self, event, peer_id, *details):
+        if event == MESSAGE:
+            message_type, payload = details[0]
+            self.handle_message(peer_id, message_type, payload)
+        elif event == CLOSED:
+            self.flush()                    # Chunks it sent before leaving are on our board, the others need them too
+            self.told.pop(peer_id, None)
+            self.addrs.pop(peer_id, None)
+            name = self.clients.pop(peer_id, None)
+            if name is not None:
+                print(f"Client left: {name} ({details[0]})")
+                if name not in self.clients.values():
+                    for told in self.told.values():
+                        told.discard(name)
+                    self.net.broadcast(encode(GONE, {name: (self.ip, self.port)}), list(self.clients))
+                if self.announcer:
+                    self.announcer.notify()
+        elif event == CONNECTED:
+            pass                            # A client is only known once its HELLO arrives
+
+    def handle_message(self, peer_id, message_type, payload):
+        if peer_id not in self.clients and message_type != HELLO:
+            return
+        self.metrics.inc(f"messages_{message_type}")
+        if message_type == DRAW:
+            for chunk in payload:
+                self.board.apply_chunk(*chunk)
+            self.pending.setdefault(peer_id, []).extend(payload)
+            return
+        self.flush()                        # Keep every other message in order with the DRAW data before it
+        if message_type == HELLO:
+            name, ip, port, sync = payload
+            self.clients[peer_id] = name
+            self.addrs[peer_id] = (ip, port)
+            print(f"Client joined: {name} ({ip}:{port})")
+            if self.announcer:
+                self.announcer.notify()
+            if sync:
+                for frame in sync_frames(self.board):
+                    self.net.send(peer_id, frame)
+            elif (ip, port) in self.marks:
+                self.net.send(peer_id, encode(SYNC_ACK, self.marks[(ip, port)]))    # Back after losing its connection
+            self.broadcast_roster()
+        elif message_type == CLEAR:
+            self.board.clear(payload)
+            self.forward(peer_id, encode(CLEAR, payload))
+            self.log(CLEAR, payload)
+        elif message_type == TOMBSTONE:
+            for stroke_id, stamp, removed in payload:
+                self.board.set_removed(stroke_id, removed, stamp)
+            self.forward(peer_id, encode(TOMBSTONE, payload))
+            self.log(TOMBSTONE, payload)
+        elif message_type == SNAPSHOT:
+            strokes = apply_snapshot(self.board, payload)
+            self.forward(peer_id, encode(SNAPSHOT, payload))
+            if self.session_log:
+                self.session_log.append_strokes(strokes)
+        elif message_type == SYNC_ACK:
+            for frame in catch_up_frames(self.board, payload):
+                self.net.send(peer_id, frame)
+        elif message_type == PING:
+            self.marks[self.addrs[peer_id]] = payload
+        # PEER lists from clients are ignored: the relay owns the roster
+
+    def flush(self):
+        # One chunk list per sender for everything it sent during this pass
+        for peer_id, chunks in self.pending.items():
+            targets = self.targets(peer_id)
+            self.net.broadcast_strokes(chunks, targets)
+            self.metrics.inc("draw_chunks_fanned_out", len(chunks) * len(targets))
+            self.log(DRAW, chunks)
+        self.pending.clear()
+
+    def targets(self, sender):
+        return [peer_id for peer_id in self.clients if peer_id != sender]
+
+    def forward(self, sender, frame):
+        targets = self.targets(sender)
+        self.net.broadcast(frame, targets)
+        self.metrics.inc("frames_encoded")
+        self.metrics.inc("frames_fanned_out", len(targets))
+
+    def broadcast_roster(self):
+        # Clients merge rosters, so each one is only sent the names it has not seen
+        names = set(self.clients.values())
+        for peer_id in self.clients:
+            told = self.told.setdefault(peer_id, set())
+            if names - told:
+                self.net.send(peer_id, encode(PEER, {name: (self.ip, self.port) for name in names - told}))
+                told |= names
+
+    def log(self, message_type, payload=None):
+        if self.session_log:
+            self.session_log.append(message_type, payload)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run a headless whiteboard relay that clients join with a room code.")
+    parser.add_argument("--ip", default=None, help="address to listen on (default: this host's address)")
+    parser.add_argument("--port", type=int, default=0, help="port to listen on (default: any free port)")
+    parser.add_argument("--room", default=None, help="room code to announce (default: a random code)")
+    parser.add_argument("--log", default=None, help="session log file to record the room to")
+    parser.add_argument("--metrics", default=None, help="file rewritten every few seconds with metrics (.json, otherwise Prometheus text)")
+    args = parser.parse_args(argv)
+    ip = args.ip or socket.gethostbyname(socket.gethostname())
+    room_code = args.room or "".join(random.choices(string.ascii_uppercase + string.digits, k=6))
+    Relay(ip, args.port, room_code, args.log, args.metrics).serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,268 @@
+import collections
+import time
+import tkinter as tk
+
+from metrics import Metrics
+from protocol import COORD_MIN, COORD_MAX
+from spatial import GridIndex, catmull_rom, distance_to_polyline
+from tiles import TileCompositor
+
+
+RENDER_MS = 16              # Render tick interval (about 60 frames per second)
+FRAME_BUDGET_MS = 8         # Time a single tick may spend issuing canvas calls
+VIEW_MARGIN = 0.5           # Extra screens kept materialized around the view, avoids churn while panning
+MIN_ZOOM, MAX_ZOOM = 0.1, 8.0
+HIT_RADIUS = 6              # Screen pixels around the pointer that count as touching a stroke
+
+
+class Viewport:
+    # Maps board (world) coordinates to canvas (screen) coordinates:
+    # screen = (world - origin) * scale
+    # Board points are int16 (see board.py), so the view is kept inside that range.
+
+    def __init__(self):
+        self.x = 0.0        # World coordinate shown at the left edge of the canvas
+        self.y = 0.0        # World coordinate shown at the top edge of the canvas
+        self.scale = 1.0
+
+    def to_world(self, sx, sy):
+        x, y = int(round(self.x + sx / self.scale)), int(round(self.y + sy / self.scale))
+        return min(max(x, COORD_MIN), COORD_MAX), min(max(y, COORD_MIN), COORD_MAX)
+
+    def clamp(self, width, height):
+        # Moves the origin so a width x height canvas only shows board coordinates
+        w, h = width / self.scale, height / self.scale
+        self.x = min(max(self.x, COORD_MIN), max(COORD_MAX - w, COORD_MIN))
+        self.y = min(max(self.y, COORD_MIN), max(COORD_MAX - h, COORD_MIN))
+
+    def to_screen(self, points):
+        scale, ox, oy = self.scale, self.x, self.y
+        screen = [0.0] * len(points)
+        screen[0::2] = [(x - ox) * scale for x in points[0::2]]
+        screen[1::2] = [(y - oy) * scale for y in points[1::2]]
+        return screen
+
+    def world_rect(self, width, height, margin=0.0):
+        w, h = width / self.scale, height / self.scale
+        return self.x - w * margin, self.y - h * margin, self.x + w * (1 + margin), self.y + h * (1 + margin)
+
+
+class RenderQueue:
+    # Strokes that changed (usually because points arrived from a peer) are queued
+    # here and drawn on the Tk thread from a periodic after() tick. Every stroke is a
+    # single multi-point polyline item: new points update the coordinates of the
+    # existing item instead of adding one item per segment. Each tick stops when its
+    # frame budget is used up and leaves the rest for the next tick.
+    #
+    # Only strokes whose box intersects the viewport (plus a margin) exist as canvas
+    # items. The grid index answers "what is on screen", and items that leave the view
+    # are deleted, so the canvas holds what is visible rather than the whole session.
+    #
+    # With an offloader, curves are smoothed in a worker process (Catmull-Rom) and
+    # drawn as plain polylines; until a stroke's curve is back its raw points are shown.
+    # Without one, Tk's own spline (smooth=True) is used.
+
+    def __init__(self, canvas, budget_ms=FRAME_BUDGET_MS, interval_ms=RENDER_MS, metrics=None, offload=None):
+        self.canvas = canvas
+        self.metrics = metrics or Metrics()
+        self.offload = offload
+        self.smoothed = {}                          # stroke_id -> (point count, smoothed curve)
+        self.smoothing = {}                         # stroke_id -> point count of the job in flight
+        self.budget = budget_ms / 1000
+        self.interval_ms = interval_ms
+        self.viewport = Viewport()
+        self.index = GridIndex()
+        self.dirty = collections.OrderedDict()     # stroke_id -> Stroke waiting to be drawn
+        self.items = {}                             # stroke_id -> canvas item id
+        self.view_changed = False
+        self.after_id = None
+        self.tiles = TileCompositor(self)          # Flattens settled strokes into cached image tiles
+
+    def start(self, master):
+        self.master = master
+        self.after_id = master.after(self.interval_ms, self.tick)
+
+    def stop(self):
+        if self.after_id is not None:
+            self.master.after_cancel(self.after_id)
+            self.after_id = None
+
+    def push_stroke(self, stroke):
+        self.index.update(stroke)
+        self.tiles.touch(stroke)
+        self.dirty[stroke.stroke_id] = stroke       # Several updates to one stroke collapse into one redraw
+
+    def show_stroke(self, stroke):
+        # Local stroke finished: draw it now rather than on the next tick
+        self.push_stroke(stroke)
+        del self.dirty[stroke.stroke_id]
+        self.draw_stroke(stroke)
+
+    def remove_stroke(self, stroke_id):
+        # Erased or undone: the stroke leaves the index, the canvas and any tile showing it
+        self.tiles.forget(stroke_id)
+        self.index.remove(stroke_id)
+        self.dirty.pop(stroke_id, None)
+        self.smoothed.pop(stroke_id, None)
+        item = self.items.pop(stroke_id, None)
+        if item is not None:
+            self.canvas.delete(item)
+
+    def stroke_at(self, sx, sy, radius=HIT_RADIUS):
+        # Topmost stroke passing within radius screen pixels of (sx, sy), or None
+        view = self.viewport
+        x, y = view.x + sx / view.scale, view.y + sy / view.scale
+        reach = radius / view.scale
+        for stroke_id in reversed(self.index.query(x - reach, y - reach, x + reach, y + reach)):
+            stroke = self.index.strokes[stroke_id]
+            if distance_to_polyline(stroke.points, x, y) <= reach + stroke.width / 2:
+                return stroke_id
+        return None
+
+    def clear(self):
+        # Forget queued strokes and wipe the canvas right away
+        self.dirty.clear()
+        self.items.clear()
+        self.smoothed.clear()
+        self.index.clear()
+        self.tiles.clear()
+        self.canvas.delete("all")
+
+    # Navigation
+    def pan(self, dx, dy):
+        # Screen-space pan: existing items move in one canvas call, culling happens on the next tick
+        view = self.viewport
+        x, y = view.x, view.y
+        view.x -= dx / view.scale
+        view.y -= dy / view.scale
+        view.clamp(self.canvas.winfo_width(), self.canvas.winfo_height())
+        self.canvas.move("all", (x - view.x) * view.scale, (y - view.y) * view.scale)
+        self.view_changed = True
+
+    def zoom(self, factor, sx, sy):
+        # Zoom around the screen point (sx, sy), every visible item gets new coordinates
+        view = self.viewport
+        scale = min(max(view.scale * factor, MIN_ZOOM), MAX_ZOOM)
+        if scale == view.scale:
+            return
+        wx, wy = view.x + sx / view.scale, view.y + sy / view.scale
+        view.scale = scale
+        view.x, view.y = wx - sx / scale, wy - sy / scale
+        view.clamp(self.canvas.winfo_width(), self.canvas.winfo_height())
+        self.redraw_items()
+
+    def reset_view(self):
+        self.viewport.x = self.viewport.y = 0.0
+        self.viewport.scale = 1.0
+        self.redraw_items()
+
+    def redraw_items(self):
+        # Every materialized item needs new screen coordinates
+        for stroke_id in self.items:
+            self.dirty[stroke_id] = self.index.strokes[stroke_id]
+        self.view_changed = True
+
+    def visible_rect(self, margin=0.0):
+        width, height = self.canvas.winfo_width(), self.canvas.winfo_height()
+        if width <= 1 or height <= 1:
+            width, height = int(self.canvas.cget("width")), int(self.canvas.cget("height"))    # Not mapped yet, use the requested size
+        return self.viewport.world_rect(width, height, margin)
+
+    def cull(self):
+        # Materialize strokes that came into view and evict the ones that left it.
+        # Flattened strokes are not materialized, the tiles covering them are
+        view_rect = self.visible_rect(VIEW_MARGIN)
+        visible = [i for i in self.index.query(*view_rect) if i not in self.tiles.flattened]
+        keep = set(visible)
+        for stroke_id in [i for i in self.items if i not in keep]:
+            self.canvas.delete(self.items.pop(stroke_id))
+            self.dirty.pop(stroke_id, None)
+        strokes = self.index.strokes
+        for stroke_id in visible:
+            if stroke_id not in self.items:
+                self.dirty[stroke_id] = strokes[stroke_id]
+        self.tiles.cull(view_rect)
+
+    def tick(self):
+        started = time.perf_counter()
+        try:
+            if self.view_changed:
+                self.view_changed = False
+                self.cull()
+            if self.drain():
+                self.metrics.observe("render_tick", time.perf_counter() - started)
+            self.tiles.tick()
+        finally:
+            self.after_id = self.master.after(self.interval_ms, self.tick)
+
+    def drain(self):
+        deadline = time.perf_counter() + self.budget
+        drawn = 0
+        if self.dirty:
+            x0, y0, x1, y1 = self.visible_rect(VIEW_MARGIN)
+            bounds = self.index.bounds
+        while self.dirty and time.perf_counter() < deadline:
+            stroke_id, stroke = self.dirty.popitem(last=False)
+            box = bounds.get(stroke_id)
+            if box is None or box[0] > x1 or box[2] < x0 or box[1] > y1 or box[3] < y0:
+                continue                            # Off screen, it is drawn when the view reaches it
+            self.draw_stroke(stroke)
+            drawn += 1
+        return drawn
+
+    # Smoothing
+    def smoothed_points(self, stroke):
+        # The stroke's curve if it is up to date, its raw points otherwise
+        cached = self.smoothed.get(stroke.stroke_id)
+        return cached[1] if cached is not None and cached[0] == stroke.point_count() else stroke.points
+
+    def request_smoothing(self, stroke):
+        # One job in flight per stroke; a stale result asks again for the newer points
+        count = stroke.point_count()
+        if count < 3 or stroke.stroke_id in self.smoothing:
+            return
+        cached = self.smoothed.get(stroke.stroke_id)
+        if cached is not None and cached[0] == count:
+            return
+        self.smoothing[stroke.stroke_id] = count
+        self.offload.submit(catmull_rom, stroke.points[:], callback=lambda curve: self.smoothing_done(stroke, count, curve),
+                            error=lambda e: self.smoothing_failed(stroke, e))
+
+    def smoothing_failed(self, stroke, error):
+        # The raw points stay on screen; the next points to arrive ask again
+        self.smoothing.pop(stroke.stroke_id, None)
+        print(f"Smoothing failed: {error}")
+
+    def smoothing_done(self, stroke, count, curve):
+        self.smoothing.pop(stroke.stroke_id, None)
+        if self.index.strokes.get(stroke.stroke_id) is not stroke:
+            return                                  # Cleared or removed meanwhile
+        if stroke.point_count() != count:
+            self.request_smoothing(stroke)
+            return
+        self.smoothed[stroke.stroke_id] = (count, curve)
+        if stroke.stroke_id in self.items:
+            self.dirty[stroke.stroke_id] = stroke
+
+    def draw_stroke(self, stroke):
+        coords = stroke.points
+        if len(coords) < 2:
+            return
+        self.index.update(stroke)
+        smooth = tk.TRUE
+        if self.offload is not None:
+            smooth = tk.FALSE
+            self.request_smoothing(stroke)
+            coords = self.smoothed_points(stroke)
+        if len(coords) == 2:
+            coords = (coords[0], coords[1], coords[0], coords[1])     # A single click still leaves a dot
+        coords = self.viewport.to_screen(coords)
+        item = self.items.get(stroke.stroke_id)
+        width = max(stroke.width * self.viewport.scale, 1)
+        if item is None:
+            self.items[stroke.stroke_id] = self.canvas.create_line(*coords, width=width, fill=stroke.color, capstyle=tk.ROUND, joinstyle=tk.ROUND, smooth=smooth)
+            self.metrics.inc("canvas_create_line")
+        else:
+            self.canvas.coords(item, *coords)
+            self.canvas.itemconfigure(item, width=width)
+            self.metrics.inc("canvas_coords")
@@ -0,0 +1,258 @@
+import bisect
+import mmap
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+
+from board import Board
+from protocol import CLEAR, DRAW, TOMBSTONE, HEADER, TYPE_NAMES, DECODERS, encode, unpack_body
+from raster import Raster
+
+
+# Session log file: MAGIC, then one record per operation. A record is the time it
+# happened (float64 seconds since the epoch) followed by the operation as a regular
+# protocol frame, so the log reuses the wire codec and can be decoded with it.
+#
+# Every CHECKPOINT_RECORDS records the writer adds a checkpoint: the whole board as
+# a DRAW of every stroke, a TOMBSTONE of every tombstone and a CLEAR of its clear
+# stamp, all with the same timestamp. A group of records ending in a CLEAR holds
+# everything still visible after it, so a replay can start at the group.
+MAGIC = b"WBLOG1\n"
+RECORD_TIME = struct.Struct("!d")
+FLUSH_INTERVAL = 0.5        # Seconds between writes to disk
+CHECKPOINT_RECORDS = 1000   # Records between checkpoints, bounds the replay behind board_at()
+EXPORT_MARGIN = 20          # Pixels around the drawing in exports
+MAX_EXPORT_SIZE = 8192      # Largest PNG edge the exporter will produce
+
+# Tk color names the board commonly uses, for exports that run without Tk
+NAMED_COLORS = {
+    "black": (0, 0, 0), "white": (255, 255, 255), "red": (255, 0, 0), "green": (0, 255, 0),
+    "blue": (0, 0, 255), "yellow": (255, 255, 0), "orange": (255, 165, 0), "purple": (160, 32, 240),
+    "gray": (190, 190, 190), "grey": (190, 190, 190), "brown": (165, 42, 42), "pink": (255, 192, 203),
+}
+
+
+class SessionLog:
+    # Append-only writer. append() only queues the operation; a background thread
+    # encodes and writes it, so the send and receive paths never wait on the disk.
+    # Checkpoints need the board, and are taken on the thread that calls append()
+
+    def __init__(self, path, board=None):
+        self.path = path
+        self.board = board
+        self.since_checkpoint = 0
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._writer, daemon=True)
+        self.thread.start()
+
+    def append(self, message_type, payload=None):
+        self.queue.put((time.time(), message_type, payload))
+        self.since_checkpoint += 1
+        if self.board is not None and self.since_checkpoint >= CHECKPOINT_RECORDS:
+            self.checkpoint()
+
+    def checkpoint(self):
+        # Removed strokes are kept, a redo after this point may bring them back. The
+        # CLEAR goes last: a checkpoint cut short by a crash is never replayed from
+        board = self.board
+        now = time.time()
+        self.since_checkpoint = 0
+        if board.strokes:
+            self.queue.put((now, DRAW, [(s.stroke_id, s.color, s.width, 0, s.points[:]) for s in board.strokes.values()]))
+        if board.tombstones:
+            self.queue.put((now, TOMBSTONE, [board.tombstone(stroke_id) for stroke_id in board.tombstones]))
+        self.queue.put((now, CLEAR, board.cleared))
+
+    def append_strokes(self, strokes):
+        # Whole strokes, e.g. from a snapshot or that survived a clear, logged as one DRAW
+        self.append(DRAW, [(s.stroke_id, s.color, s.width, 0, s.points[:]) for s in strokes])
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join(timeout=5)
+
+    def _writer(self):
+        while True:
+            records = [self.queue.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while records[-1] is not None and time.monotonic() < deadline:
+                try:
+                    records.append(self.queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            done = records[-1] is None
+            if done:
+                records.pop()
+            try:
+                self.file.write(b"".join(RECORD_TIME.pack(t) + encode(message_type, payload) for t, message_type, payload in records))
+                self.file.flush()
+            except Exception as e:
+                print(f"Session log error: {e}")
+            if done:
+                self.file.close()
+                return
+
+
+class SessionReader:
+    # Memory-maps a session log and indexes its CLEARs and checkpoints by time without
+    # decoding any payload. board_at() rebuilds the board at any moment by replaying
+    # from the closest one before it, decoding stroke data straight out of the mapping.
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        size = os.fstat(self.file.fileno()).st_size
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        if self.data[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"Not a whiteboard session log: {path}")
+        self.first_time = None      # Timestamp of the first record
+        self.clear_times = []       # Timestamp of every CLEAR, checkpoints included
+        self.clear_offsets = []     # File offset of the first record sharing each CLEAR's timestamp
+        self.count = 0
+        self.end = len(MAGIC)
+        self._scan()
+
+    def _scan(self):
+        data, offset, end = self.data, len(MAGIC), len(self.data)
+        record_header = RECORD_TIME.size + HEADER.size
+        clear_code = next(code for code, name in TYPE_NAMES.items() if name == CLEAR)
+        group_time = group_offset = None
+        while offset + record_header <= end:
+            (timestamp,) = RECORD_TIME.unpack_from(data, offset)
+            length, code = HEADER.unpack_from(data, offset + RECORD_TIME.size)
+            next_offset = offset + record_header + length
+            if next_offset > end:
+                break                                   # Truncated last record (crash while writing)
+            if self.first_time is None:
+                self.first_time = timestamp
+            if timestamp != group_time:
+                group_time, group_offset = timestamp, offset
+            if code == clear_code:
+                self.clear_times.append(timestamp)
+                self.clear_offsets.append(group_offset)     # Also the rest of a checkpoint
+            self.count += 1
+            offset = next_offset
+        self.end = offset
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+
+    def start_time(self):
+        return self.first_time
+
+    def records(self, start=None, until=None):
+        # Yields (timestamp, message_type, payload) from file offset start
+        data = self.data
+        offset = len(MAGIC) if start is None else start
+        record_header = RECORD_TIME.size + HEADER.size
+        view = memoryview(data)
+        try:
+            while offset < self.end:
+                (timestamp,) = RECORD_TIME.unpack_from(data, offset)
+                if until is not None and timestamp > until:
+                    return
+                length, code = HEADER.unpack_from(data, offset + RECORD_TIME.size)
+                body_start = offset + record_header
+                message_type, body = unpack_body(code, view[body_start:body_start + length])
+                yield timestamp, message_type, DECODERS[message_type](body)
+                offset = body_start + length
+        finally:
+            view.release()
+
+    def board_at(self, at=None, author=""):
+        # Board as it was at time `at` (seconds since the epoch), or at the end of the log
+        board = Board(author)
+        start = None
+        if self.clear_times:
+            i = len(self.clear_times) if at is None else bisect.bisect_right(self.clear_times, at)
+            if i:
+                start = self.clear_offsets[i - 1]       # Nothing before this CLEAR or checkpoint can still be visible
+        for timestamp, message_type, payload in self.records(start, at):
+            if message_type == DRAW:
+                for chunk in payload:
+                    board.apply_chunk(*chunk)
+            elif message_type == CLEAR:
+                board.clear(payload)
+            elif message_type == TOMBSTONE:
+                for stroke_id, stamp, removed in payload:
+                    board.set_removed(stroke_id, removed, stamp)
+        return board
+
+
+# Headless export
+def parse_color(color):
+    if color.startswith("#") and len(color) in (4, 7, 13):
+        digits = (len(color) - 1) // 3
+        return tuple(int(color[1 + i * digits:1 + (i + 1) * digits], 16) * 255 // (16 ** digits - 1) for i in range(3))
+    return NAMED_COLORS.get(color.lower(), (0, 0, 0))
+
+
+def board_bounds(board):
+    boxes = [stroke.bbox() for stroke in board if stroke.points]
+    if not boxes:
+        return 0, 0, 1, 1
+    return (min(b[0] for b in boxes) - EXPORT_MARGIN, min(b[1] for b in boxes) - EXPORT_MARGIN,
+            max(b[2] for b in boxes) + EXPORT_MARGIN, max(b[3] for b in boxes) + EXPORT_MARGIN)
+
+
+def export_png(board, path, scale=1.0, background="white"):
+    x0, y0, x1, y1 = board_bounds(board)
+    scale = min(scale, MAX_EXPORT_SIZE / max(x1 - x0, y1 - y0, 1))
+    raster = Raster(max(int((x1 - x0) * scale), 1), max(int((y1 - y0) * scale), 1), parse_color(background) if background else None)
+    for stroke in board:
+        raster.draw_stroke(stroke.points, parse_color(stroke.color), stroke.width, x0, y0, scale)
+    with open(path, "wb") as f:
+        f.write(raster.to_png())
+
+
+def export_svg(board, path, background="white"):
+    x0, y0, x1, y1 = board_bounds(board)
+    lines = [f'<svg xmlns="http://www.w3.org/2000/svg" viewBox="{x0} {y0} {x1 - x0} {y1 - y0}" width="{x1 - x0}" height="{y1 - y0}">']
+    if background:
+        lines.append(f'<rect x="{x0}" y="{y0}" width="{x1 - x0}" height="{y1 - y0}" fill="{background}"/>')
+    for stroke in board:
+        points = stroke.points
+        if len(points) == 2:
+            points = points * 2
+        coords = " ".join(f"{points[i]},{points[i + 1]}" for i in range(0, len(points), 2))
+        lines.append(f'<polyline points="{coords}" fill="none" stroke="{stroke.color}" stroke-width="{stroke.width}" stroke-linecap="round" stroke-linejoin="round"/>')
+    lines.append("</svg>")
+    with open(path, "w") as f:
+        f.write("\n".join(lines))
+
+
+def export(board, path, **options):
+    if path.lower().endswith(".svg"):
+        export_svg(board, path, **options)
+    else:
+        export_png(board, path, **options)
+
+
+def export_bytes(data, path, **options):
+    # Export from Board.to_bytes() output, for running in a worker process
+    export(Board.from_bytes("", data), path, **options)
+    return path
+
+
+# Command line: python session_log.py info LOG | export LOG OUT.png|OUT.svg [SECONDS]
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[1] not in ("info", "export"):
+        sys.exit("usage: session_log.py info LOG | export LOG OUT.png|OUT.svg [SECONDS_FROM_START]")
+    reader = SessionReader(sys.argv[2])
+    if sys.argv[1] == "info":
+        board = reader.board_at()
+        print(f"{reader.count} records, {len(reader.clear_times)} clears and checkpoints, {len(board)} strokes ({board.segment_count()} segments) at the end")
+    else:
+        at = reader.start_time() + float(sys.argv[4]) if len(sys.argv) > 4 and reader.start_time() else None
+        export(reader.board_at(at), sys.argv[3])
+    reader.close()
@@ -0,0 +1,135 @@
+import math
+from array import array
+from collections import defaultdict
+
+
+CELL_SIZE = 256     # World pixels per grid cell
+SMOOTH_STEP = 4.0   # World pixels between two points of a smoothed curve
+MAX_SMOOTH_SAMPLES = 8
+
+
+def catmull_rom(points, step=SMOOTH_STEP, max_samples=MAX_SMOOTH_SAMPLES):
+    # Curve through every point of a flat x0, y0, x1, y1, ... polyline (uniform
+    # Catmull-Rom), sampled about every `step` pixels. Replaces Tk's smooth=True
+    # spline, which Tk recomputes on every redraw of the item.
+    xs, ys = points[0::2], points[1::2]
+    n = len(xs)
+    if n < 3:
+        return array("f", points)
+    curve = array("f", (xs[0], ys[0]))
+    for i in range(n - 1):
+        x0, y0 = (xs[i - 1], ys[i - 1]) if i else (xs[0], ys[0])
+        x1, y1, x2, y2 = xs[i], ys[i], xs[i + 1], ys[i + 1]
+        x3, y3 = (xs[i + 2], ys[i + 2]) if i + 2 < n else (x2, y2)
+        samples = min(max(int(math.hypot(x2 - x1, y2 - y1) / step), 1), max_samples)
+        for k in range(1, samples + 1):
+            t = k / samples
+            t2, t3 = t * t, t * t * t
+            curve.append(0.5 * (2 * x1 + (x2 - x0) * t + (2 * x0 - 5 * x1 + 4 * x2 - x3) * t2 + (3 * x1 - x0 - 3 * x2 + x3) * t3))
+            curve.append(0.5 * (2 * y1 + (y2 - y0) * t + (2 * y0 - 5 * y1 + 4 * y2 - y3) * t2 + (3 * y1 - y0 - 3 * y2 + y3) * t3))
+    return curve
+
+
+def distance_to_polyline(points, x, y):
+    # Shortest distance from (x, y) to the polyline through flat points x0, y0, x1, y1, ...
+    best = float("inf")
+    for i in range(0, max(len(points) - 2, 1), 2):
+        ax, ay = points[i], points[i + 1]
+        bx, by = (points[i + 2], points[i + 3]) if i + 3 < len(points) else (ax, ay)
+        dx, dy = bx - ax, by - ay
+        length = dx * dx + dy * dy
+        t = 0.0 if length == 0 else max(0.0, min(1.0, ((x - ax) * dx + (y - ay) * dy) / length))
+        cx, cy = ax + t * dx - x, ay + t * dy - y
+        best = min(best, cx * cx + cy * cy)
+    return best ** 0.5
+
+
+class GridIndex:
+    # Uniform grid over stroke bounding boxes. Each stroke is registered in every cell
+    # its box touches, so "what is inside this rectangle" only looks at the cells the
+    # rectangle covers, however many strokes the session has produced elsewhere.
+
+    def __init__(self, cell_size=CELL_SIZE):
+        self.cell_size = cell_size
+        self.cells = defaultdict(set)   # (cx, cy) -> stroke ids
+        self.strokes = {}               # stroke_id -> Stroke
+        self.bounds = {}                # stroke_id -> [x0, y0, x1, y1, points already indexed]
+        self.order = {}                 # stroke_id -> insertion counter, keeps the drawing order
+        self.counter = 0
+
+    def __len__(self):
+        return len(self.strokes)
+
+    def __contains__(self, stroke_id):
+        return stroke_id in self.strokes
+
+    def _cell_range(self, x0, y0, x1, y1):
+        size = self.cell_size
+        return range(int(x0 // size), int(x1 // size) + 1), range(int(y0 // size), int(y1 // size) + 1)
+
+    def update(self, stroke):
+        # Grows the stroke's box with the points added since the last update. Boxes only
+        # grow, which keeps this incremental and never loses a stroke from a query
+        points = stroke.points
+        if len(points) < 2:
+            return
+        stroke_id = stroke.stroke_id
+        bounds = self.bounds.get(stroke_id)
+        if bounds is None:
+            self.strokes[stroke_id] = stroke
+            self.order[stroke_id] = self.counter
+            self.counter += 1
+            old = None
+            bounds = self.bounds[stroke_id] = [points[0], points[1], points[0], points[1], 0]
+        else:
+            old = bounds[:4]
+        start = bounds[4] * 2
+        if start >= len(points) and old is not None:
+            return
+        xs, ys = points[start::2], points[start + 1::2]
+        bounds[0], bounds[1] = min(bounds[0], min(xs)), min(bounds[1], min(ys))
+        bounds[2], bounds[3] = max(bounds[2], max(xs)), max(bounds[3], max(ys))
+        bounds[4] = len(points) // 2
+        if old == bounds[:4]:
+            return
+        old_cols, old_rows = self._cell_range(*old) if old else (range(0), range(0))
+        cols, rows = self._cell_range(*bounds[:4])
+        for cx in cols:
+            for cy in rows:
+                if cx not in old_cols or cy not in old_rows:
+                    self.cells[(cx, cy)].add(stroke_id)
+
+    def remove(self, stroke_id):
+        bounds = self.bounds.pop(stroke_id, None)
+        if bounds is None:
+            return
+        del self.strokes[stroke_id]
+        del self.order[stroke_id]
+        cols, rows = self._cell_range(*bounds[:4])
+        for cx in cols:
+            for cy in rows:
+                cell = self.cells.get((cx, cy))
+                if cell is not None:
+                    cell.discard(stroke_id)
+                    if not cell:
+                        del self.cells[(cx, cy)]
+
+    def clear(self):
+        self.cells.clear()
+        self.strokes.clear()
+        self.bounds.clear()
+        self.order.clear()
+
+    def query(self, x0, y0, x1, y1):
+        # Ids of strokes whose box intersects the rectangle, in drawing order
+        found = set()
+        cols, rows = self._cell_range(x0, y0, x1, y1)
+        for cx in cols:
+            for cy in rows:
+                cell = self.cells.get((cx, cy))
+                if cell:
+                    found |= cell
+        bounds = self.bounds
+        hits = [i for i in found if bounds[i][0] <= x1 and bounds[i][2] >= x0 and bounds[i][1] <= y1 and bounds[i][3] >= y0]
+        hits.sort(key=self.order.__getitem__)
+        return hits
@@ -0,0 +1,70 @@
+import zlib
+
+from protocol import CLEAR, SNAPSHOT, SYNC_END, TOMBSTONE, encode
+
+
+SNAPSHOT_PART_BYTES = 256 * 1024    # Raw stroke bytes per SNAPSHOT frame, before compression
+COMPRESS_LEVEL = 1                  # Coordinates compress well even at the fastest level
+
+
+# Late-joiner sync
+#
+#   joiner                           peer it connected to
+#   HELLO (sync=True)  ------------>
+#                      <------------ [CLEAR] [TOMBSTONE] SNAPSHOT ... SNAPSHOT, SYNC_END(version)
+#   SYNC_ACK(version)  ------------>
+#                      <------------ [CLEAR] [TOMBSTONE] SNAPSHOT of what changed since version
+#
+# Each SNAPSHOT frame holds whole strokes compressed on their own, so the joiner can
+# apply and render every frame as it lands instead of waiting for the whole board.
+# Points are written at fixed indexes (see Stroke.write), so anything that reaches
+# the joiner both live and in a snapshot is applied twice harmlessly. The clear stamp
+# and tombstones go first, so removed strokes are never shown while syncing.
+
+def snapshot_parts(board, strokes):
+    # Uncompressed stroke bytes, one part per SNAPSHOT frame
+    group, size = [], 0
+    for stroke in strokes:
+        group.append(stroke)
+        size += len(stroke.points) * 2 + 32
+        if size >= SNAPSHOT_PART_BYTES:
+            yield board.to_bytes(group)
+            group, size = [], 0
+    if group:
+        yield board.to_bytes(group)
+
+
+def compress_part(raw):
+    # Module level so it can run in a worker process (offload.Offloader)
+    return zlib.compress(raw, COMPRESS_LEVEL)
+
+
+def sync_frames(board):
+    # Everything a joiner needs, taken in one go so live DRAW frames queued after it
+    # on the same connection can only ever extend what the snapshot contains
+    frames = catch_up_frames(board, 0)
+    frames.append(encode(SYNC_END, board.version))
+    return frames
+
+
+def catch_up_frames(board, version):
+    head, parts = catch_up_plan(board, version)
+    return head + [encode(SNAPSHOT, compress_part(raw)) for raw in parts]
+
+
+def catch_up_plan(board, version):
+    # Frames to send right away and the raw snapshot parts still to compress, so the
+    # compression can run elsewhere. Removed strokes are sent too, a redo anywhere
+    # may bring them back
+    head = []
+    if board.cleared_version > version:
+        head.append(encode(CLEAR, board.cleared))
+    tombstones = board.tombstones_since(version)
+    if tombstones:
+        head.append(encode(TOMBSTONE, tombstones))
+    return head, list(snapshot_parts(board, board.changed_since(version)))
+
+
+def apply_snapshot(board, data):
+    # Returns the strokes that changed so the caller can queue them for rendering
+    return board.load(zlib.decompress(data))
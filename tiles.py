@@ -0,0 +1,220 @@
+import base64
+import collections
+import queue
+import threading
+import time
+import tkinter as tk
+
+from raster import Raster
+
+
+TILE_SIZE = 256             # Tile edge in screen pixels
+SETTLE_SECONDS = 10         # Strokes untouched for this long may be flattened into tiles
+FLATTEN_INTERVAL_MS = 1000  # How often to look for strokes to flatten
+FLATTEN_MIN_ITEMS = 100     # Below this many vector items flattening is not worth it
+MAX_FLATTEN_BATCH = 500     # Strokes flattened per pass
+MAX_CACHED_TILES = 128      # Tile images kept in memory (256x256 RGBA, about 256 KB each in Tk)
+TILE_TAG = "tile"
+
+
+class TileCompositor:
+    # Flattens settled strokes into fixed-size image tiles. A background thread
+    # rasterizes tiles (raster.Raster) while the Tk thread keeps drawing; once every
+    # tile covering a batch of strokes is ready, the images go on the canvas under the
+    # vector items and the strokes' line items are deleted. Tiles are keyed by
+    # (scale, column, row) and kept in an LRU cache, so panning back over old areas
+    # reuses them instead of redrawing thousands of lines.
+
+    def __init__(self, renderer, tile_size=TILE_SIZE, settle_seconds=SETTLE_SECONDS, max_tiles=MAX_CACHED_TILES):
+        self.renderer = renderer
+        self.canvas = renderer.canvas
+        self.tile_size = tile_size
+        self.settle_seconds = settle_seconds
+        self.max_tiles = max_tiles
+        self.flattened = set()                      # Stroke ids that only exist inside tiles
+        self.touched = {}                           # stroke_id -> time of its last change
+        self.cache = collections.OrderedDict()      # (scale, tx, ty) -> PhotoImage, least recently used first
+        self.tile_items = {}                        # (scale, tx, ty) -> canvas image item
+        self.versions = collections.defaultdict(int)    # Bumped whenever a tile's content becomes stale
+        self.pending = {}                           # (scale, tx, ty) -> version being rasterized right now
+        self.batches = {}                           # batch id -> (stroke ids, tile keys left, start time)
+        self.batch_ids = 0
+        self.colors = {}                            # Tk color name -> (r, g, b)
+        self.generation = 0                         # Bumped on clear, drops every job in flight
+        self.next_scan = 0
+        self.jobs = queue.Queue()
+        self.results = queue.Queue()
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    # Stroke bookkeeping, called by the renderer
+    def touch(self, stroke):
+        self.touched[stroke.stroke_id] = time.monotonic()
+        if stroke.stroke_id in self.flattened:
+            self.forget(stroke.stroke_id)           # It changed: back to a vector item
+
+    def forget(self, stroke_id):
+        # The stroke changed or went away, every tile that may show it is stale
+        self.flattened.discard(stroke_id)
+        bounds = self.renderer.index.bounds.get(stroke_id)
+        if bounds is None:
+            return
+        for key in list(self.cache) + list(self.tile_items):
+            x0, y0, x1, y1 = self.tile_rect(key)
+            if bounds[0] <= x1 and bounds[2] >= x0 and bounds[1] <= y1 and bounds[3] >= y0:
+                self.versions[key] += 1
+                self.cache.pop(key, None)
+                item = self.tile_items.pop(key, None)
+                if item is not None:
+                    self.canvas.delete(item)
+        self.renderer.view_changed = True           # Redraw the stroke and re-request the tiles
+
+    def clear(self):
+        self.generation += 1
+        self.flattened.clear()
+        self.touched.clear()
+        self.cache.clear()
+        self.tile_items.clear()
+        self.versions.clear()
+        self.pending.clear()
+        self.batches.clear()
+
+    # Geometry
+    def tile_rect(self, key):
+        scale, tx, ty = key
+        size = self.tile_size / scale
+        return tx * size, ty * size, (tx + 1) * size, (ty + 1) * size
+
+    def keys_in(self, x0, y0, x1, y1):
+        scale = self.renderer.viewport.scale
+        size = self.tile_size / scale
+        return [(scale, tx, ty) for tx in range(int(x0 // size), int(x1 // size) + 1)
+                for ty in range(int(y0 // size), int(y1 // size) + 1)]
+
+    # Canvas side
+    def cull(self, view_rect):
+        visible = set(self.keys_in(*view_rect))
+        for key in [k for k in self.tile_items if k not in visible]:
+            self.canvas.delete(self.tile_items.pop(key))
+        index = self.renderer.index
+        for key in visible:
+            if key in self.tile_items:
+                continue
+            if key in self.cache:
+                self.place(key)
+            elif self.pending.get(key) != self.versions[key] and self.flattened and any(i in self.flattened for i in index.query(*self.tile_rect(key))):
+                self.request(key)
+
+    def place(self, key):
+        view = self.renderer.viewport
+        x0, y0, _, _ = self.tile_rect(key)
+        item = self.canvas.create_image((x0 - view.x) * view.scale, (y0 - view.y) * view.scale, image=self.cache[key], anchor=tk.NW, tags=TILE_TAG)
+        self.canvas.tag_lower(item)                 # Tiles hold the oldest strokes, keep them underneath
+        self.tile_items[key] = item
+        self.cache.move_to_end(key)
+
+    def rgb(self, color):
+        if color not in self.colors:
+            r, g, b = self.canvas.winfo_rgb(color)
+            self.colors[color] = (r >> 8, g >> 8, b >> 8)
+        return self.colors[color]
+
+    def request(self, key, extra=(), batch_id=None):
+        # Snapshot what the tile must show and hand it to the worker thread
+        x0, y0, x1, y1 = self.tile_rect(key)
+        index = self.renderer.index
+        strokes = []
+        for stroke_id in index.query(x0, y0, x1, y1):
+            if stroke_id in self.flattened or stroke_id in extra:
+                stroke = index.strokes[stroke_id]
+                strokes.append((self.renderer.smoothed_points(stroke)[:], self.rgb(stroke.color), stroke.width))
+        self.pending[key] = self.versions[key]
+        self.jobs.put((self.generation, key, self.versions[key], batch_id, x0, y0, strokes))
+
+    def tick(self):
+        self.collect_results()
+        now = time.monotonic()
+        if now >= self.next_scan:
+            self.next_scan = now + FLATTEN_INTERVAL_MS / 1000
+            self.flatten_settled(now)
+
+    def flatten_settled(self, now):
+        renderer = self.renderer
+        if len(renderer.items) < FLATTEN_MIN_ITEMS:
+            return
+        visible = set(self.keys_in(*renderer.visible_rect()))
+        bounds = renderer.index.bounds
+        keys = set()
+        extra = set()
+        for stroke_id in renderer.items:
+            if stroke_id in renderer.dirty or now - self.touched.get(stroke_id, 0) < self.settle_seconds:
+                continue
+            covered = [k for k in self.keys_in(*bounds[stroke_id][:4]) if k in visible]
+            if not covered:     # Off-screen strokes have no tile to land in, leave them as items
+                continue
+            keys.update(covered)
+            extra.add(stroke_id)
+            if len(extra) >= MAX_FLATTEN_BATCH:
+                break
+        if not extra:
+            return
+        self.batch_ids += 1
+        self.batches[self.batch_ids] = (extra, keys, now)
+        for key in keys:
+            self.request(key, extra, self.batch_ids)
+
+    def collect_results(self):
+        while True:
+            try:
+                generation, key, version, batch_id, data = self.results.get_nowait()
+            except queue.Empty:
+                return
+            if generation != self.generation:
+                continue
+            if self.pending.get(key) == version:
+                del self.pending[key]
+            if self.versions[key] != version:
+                self.batches.pop(batch_id, None)    # A stroke in this tile changed meanwhile, retry later
+                continue
+            self.cache[key] = tk.PhotoImage(master=self.canvas, data=data, format="png")
+            self.renderer.metrics.inc("tiles_rasterized")
+            old = self.tile_items.pop(key, None)
+            if old is not None:
+                self.canvas.delete(old)
+            if key[0] == self.renderer.viewport.scale:
+                self.place(key)
+            self.evict()
+            batch = self.batches.get(batch_id)
+            if batch is not None:
+                batch[1].discard(key)
+                if not batch[1]:
+                    self.finish_batch(self.batches.pop(batch_id))
+
+    def finish_batch(self, batch):
+        stroke_ids, _, started = batch
+        renderer = self.renderer
+        for stroke_id in stroke_ids:
+            if self.touched.get(stroke_id, 0) > started or stroke_id not in renderer.index:
+                continue                            # Changed while its tiles were being drawn
+            self.flattened.add(stroke_id)
+            item = renderer.items.pop(stroke_id, None)
+            if item is not None:
+                self.canvas.delete(item)
+
+    def evict(self):
+        # Drop least recently used tiles that are not on the canvas
+        for key in list(self.cache):
+            if len(self.cache) <= self.max_tiles:
+                break
+            if key not in self.tile_items:
+                del self.cache[key]
+
+    # Worker thread
+    def _worker(self):
+        size = self.tile_size
+        while True:
+            generation, key, version, batch_id, x0, y0, strokes = self.jobs.get()
+            raster = Raster(size, size)
+            for points, rgb, width in strokes:
+                raster.draw_stroke(points, rgb, width, x0, y0, key[0])
+            data = base64.b64encode(raster.to_png(level=1)).decode("ascii")
+            self.results.put((generation, key, version, batch_id, data))